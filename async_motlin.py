@@ -0,0 +1,685 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from datetime import datetime
+from typing import AsyncIterator, Awaitable
+
+import aiohttp
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+
+from metrics import Metrics
+from motlin import (
+    API_URL,
+    IDEMPOTENT_METHODS,
+    TOO_MANY_REQUESTS,
+    Motlin,
+    TokenBucket,
+    TokenRenewer,
+    get_retry_delay,
+    is_retryable_error,
+    is_retryable_status,
+    parse_retry_after
+)
+from session_store import SessionStore, UserSession, session_key
+
+
+class BackgroundLoop:
+    # Event loop living in its own thread, lets synchronous telegram
+    # handlers run several coroutines concurrently and wait for all of them.
+
+    def __init__(self) -> BackgroundLoop:
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name='motlin-event-loop',
+            daemon=True
+        )
+        self.thread.start()
+
+    def run(self, coroutine: Awaitable, timeout: float):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # do not leave the coroutine running for nobody
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncMotlin:
+    EXPIRED_SPARE_TIME = 300  # seconds
+    TOKEN_LOCK_TIMEOUT = 30  # seconds
+    RUN_TIMEOUT = 60  # seconds, run_concurrently gives up waiting after that
+
+    token = str()
+    token_expired = 0
+
+    def __init__(self,
+                 client_id: str,
+                 client_secret: str,
+                 catalog_id: str,
+                 node_id: str,
+                 pricebook_id: str,
+                 flow_id: str,
+                 redis_host: str = 'localhost',
+                 redis_port: int = 6379,
+                 redis_password: str = None,
+                 redis_db: int = 0,
+                 api_url: str = API_URL,
+                 pool_maxsize: int = 16,
+                 keepalive_timeout: float = 30,
+                 rate_limit: float = 20,
+                 rate_burst: float = None,
+                 rate_limiter: TokenBucket = None,
+                 max_retries: int = Motlin.MAX_RETRIES,
+                 metrics: Metrics = None,
+                 session_ttl: int = SessionStore.SESSION_TTL,
+                 token_renewer: TokenRenewer = None) -> AsyncMotlin:
+
+        self.redis = Redis(
+            host=redis_host,
+            port=redis_port,
+            password=redis_password,
+            db=redis_db,
+            decode_responses=True
+        )
+        self.api_url = api_url.rstrip('/')
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+        self.background_loop = None
+        self.background_loop_lock = threading.Lock()
+        self._refresh_task = None
+        # pass Motlin's bucket, so both clients of a process share one limit
+        if rate_limiter is None and rate_limit:
+            rate_limiter = TokenBucket(rate_limit, rate_burst)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.session_ttl = session_ttl
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # same keys as Motlin, so both clients share one token
+        self.token_key = f'motlin:{client_id}:token'
+        self.token_lock_key = f'motlin:{client_id}:token_lock'
+        # renewer of a Motlin in the same process, see _ensure_token
+        self.token_renewer = token_renewer
+        self.catalog_id = catalog_id
+        self.node_id = node_id
+        self.pricebook_id = pricebook_id
+        self.flow_id = flow_id
+
+    def run_concurrently(self, *coroutines: Awaitable, timeout: float = RUN_TIMEOUT) -> list:
+        # blocking entry point for synchronous code, called from parallel chat
+        # workers: session and redis pool are bound to the one loop created here
+        with self.background_loop_lock:
+            if self.background_loop is None:
+                self.background_loop = BackgroundLoop()
+
+        async def gather():
+            return await asyncio.gather(*coroutines)
+
+        return self.background_loop.run(gather(), timeout)
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+        await self.redis.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # aiohttp session has to be created inside the running loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_maxsize,
+                limit_per_host=self.pool_maxsize,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def _request(self,
+                       method: str,
+                       url: str,
+                       endpoint: str,
+                       authorized: bool = True,
+                       **kwargs) -> dict:
+        # same throttling, timeouts and retry rules as Motlin._request,
+        # endpoint is required - it labels metrics and picks the timeout
+        headers = dict()
+        if authorized:
+            await self._ensure_token()
+            headers['Authorization'] = f'Bearer {self.token}'
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        connect_timeout, read_timeout = Motlin.ENDPOINT_TIMEOUTS.get(endpoint, Motlin.DEFAULT_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            started_at = time.perf_counter()
+            try:
+                async with self._get_session().request(
+                    method, url, headers=headers, timeout=timeout, **kwargs
+                ) as response:
+                    if self.metrics:
+                        self._observe_request(endpoint, method, response.status, started_at, response)
+                    if not is_retryable_status(response.status, idempotent) or attempt >= self.max_retries:
+                        response.raise_for_status()
+                        if response.content_length == 0 or response.content_type != 'application/json':
+                            return {}
+                        return await response.json()
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    delay = get_retry_delay(attempt, retry_after)
+                    if response.status == TOO_MANY_REQUESTS and self.rate_limiter:
+                        self.rate_limiter.pause(delay)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if self.metrics:
+                    self._observe_request(endpoint, method, type(error).__name__, started_at)
+                connect_failed = isinstance(error, aiohttp.ConnectionTimeoutError)
+                if not is_retryable_error(idempotent, connect_failed) or attempt >= self.max_retries:
+                    raise
+                delay = get_retry_delay(attempt)
+            if self.metrics:
+                self.metrics.inc('retries_total', {'endpoint': endpoint})
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _iter_pages(self,
+                          url: str,
+                          endpoint: str,
+                          params: dict = None,
+                          concurrent: bool = False,
+                          page_limit: int = Motlin.PAGE_LIMIT,
+                          max_workers: int = Motlin.MAX_PAGE_WORKERS) -> AsyncIterator[dict]:
+        # same paging as Motlin._iter_pages, concurrent pages are fetched in windows
+        params = {**(params or {}), 'page[limit]': page_limit, 'page[offset]': 0}
+        page = await self._request('GET', url, params=params, endpoint=endpoint)
+        yield page
+        total = page.get('meta', {}).get('results', {}).get('total')
+        if not concurrent or total is None:
+            while page['data'] and page.get('links', {}).get('next'):
+                page = await self._request('GET', page['links']['next'], endpoint=endpoint)
+                yield page
+            return
+
+        offsets = list(range(page_limit, total, page_limit))
+        for window_start in range(0, len(offsets), max_workers):
+            pages = await asyncio.gather(*(
+                self._request('GET', url, params={**params, 'page[offset]': offset}, endpoint=endpoint)
+                for offset in offsets[window_start:window_start + max_workers]
+            ))
+            for page in pages:
+                yield page
+
+    def _observe_request(self,
+                         endpoint: str,
+                         method: str,
+                         status: int | str,
+                         started_at: float,
+                         response: aiohttp.ClientResponse = None) -> None:
+        # time to response headers, body is read by the caller
+        labels = {'endpoint': endpoint, 'method': method}
+        self.metrics.observe('request_duration_seconds', labels, time.perf_counter() - started_at)
+        self.metrics.inc('responses_total', {**labels, 'status': status})
+        if response is not None and response.content_length:
+            self.metrics.inc('response_bytes_total', labels, response.content_length)
+
+    async def get_token(self) -> tuple[str]:
+        access_token_url = f'{self.api_url}/oauth/access_token'
+        access_token_data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'client_credentials',
+        }
+        # the token request itself goes without the bearer header
+        token_meta = await self._request(
+            'GET',
+            access_token_url,
+            endpoint='get_token',
+            authorized=False,
+            data=access_token_data
+        )
+        return token_meta['access_token'], int(token_meta['expires'])
+
+    def _is_token_expiring(self) -> bool:
+        return datetime.now().timestamp() + self.EXPIRED_SPARE_TIME > self.token_expired
+
+    def _is_token_expired(self) -> bool:
+        return datetime.now().timestamp() >= self.token_expired
+
+    async def _load_shared_token(self) -> bool:
+        token_meta = await self.redis.hgetall(self.token_key)
+        if not token_meta:
+            return False
+        self.token, self.token_expired = token_meta['token'], int(token_meta['expires'])
+        return True
+
+    async def _refresh_shared_token(self, lock) -> None:
+        try:
+            if await self._load_shared_token() and not self._is_token_expiring():
+                return
+            token, token_expired = await self.get_token()
+            async with self.redis.pipeline() as pipe:
+                pipe.hset(self.token_key, mapping={'token': token, 'expires': token_expired})
+                pipe.expireat(self.token_key, token_expired)
+                await pipe.execute()
+            self.token, self.token_expired = token, token_expired
+        finally:
+            try:
+                await lock.release()
+            except LockError:
+                pass
+
+    async def _ensure_token(self) -> None:
+        if not self._is_token_expiring():
+            return
+        if self.token_renewer and self.token_renewer.is_alive():
+            # renewer keeps redis up to date, just pick the token up
+            await self._load_shared_token()
+            return
+        if await self._load_shared_token() and not self._is_token_expiring():
+            return
+        lock = self.redis.lock(
+            self.token_lock_key,
+            timeout=self.TOKEN_LOCK_TIMEOUT,
+            thread_local=False
+        )
+        if not self._is_token_expired():
+            if await lock.acquire(blocking=False):
+                # keep a reference, otherwise the task may be garbage collected
+                self._refresh_task = asyncio.ensure_future(self._refresh_shared_token(lock))
+            return
+        if await lock.acquire(blocking_timeout=self.TOKEN_LOCK_TIMEOUT):
+            await self._refresh_shared_token(lock)
+        else:
+            await self._load_shared_token()
+
+    async def create_catalog(self,
+                             name: str,
+                             description: str,
+                             hierarchy_ids: list[str],
+                             pricebook_id: str) -> dict:
+        url = f'{self.api_url}/pcm/catalogs'
+        request_data = {
+            "data": {
+                "type": "catalog",
+                "attributes": {
+                    "name": name,
+                    "description": description,
+                    "hierarchy_ids": hierarchy_ids,
+                    "pricebook_id": pricebook_id
+                }
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_catalog')
+
+    async def publish_catalog(self, catalog_id: str) -> dict:
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}/releases'
+        request_data = {
+            "data": {
+                "export_full_delta": True
+            }
+        }
+        release = await self._request('POST', url, json=request_data, endpoint='publish_catalog')
+        # same cache switch as Motlin.publish_catalog
+        stale_keys = [key async for key in self.redis.scan_iter(Motlin.release_keys_pattern(catalog_id))]
+        async with self.redis.pipeline() as pipe:
+            Motlin.queue_release_switch(pipe, catalog_id, release['data']['id'], stale_keys)
+            await pipe.execute()
+        return release
+
+    async def get_catalog(self, catalog_id: str) -> dict:
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}'
+        return await self._request('GET', url, endpoint='get_catalog')
+
+    async def create_hierarchy(self, hierarchy_name: str) -> dict:
+        url = f'{self.api_url}/pcm/hierarchies/'
+        request_data = {
+            "data": {
+                "type": "hierarchy",
+                "attributes": {
+                    "name": hierarchy_name
+                }
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_hierarchy')
+
+    async def create_node(self, hierarchy_id: str, node_name: str) -> dict:
+        url = f'{self.api_url}/pcm/hierarchies/{hierarchy_id}/nodes'
+        request_data = {
+            "data": {
+                "type": "node",
+                "attributes": {
+                    "name": node_name
+                }
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_node')
+
+    async def get_product(self, product_id: str) -> dict:
+        url = f'{self.api_url}/pcm/products/{product_id}'
+        params = {
+            "include": "main_image",
+        }
+        return await self._request('GET', url, params=params, endpoint='get_product')
+
+    async def create_product(self, product_data: dict) -> dict:
+        url = f'{self.api_url}/pcm/products'
+        return await self._request('POST', url, json={"data": product_data}, endpoint='create_product')
+
+    async def create_product_node_relationship(self,
+                                               hierarchy_id: str,
+                                               node_id: str,
+                                               products_ids: list|tuple) -> dict:
+        url = f'{self.api_url}/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/relationships/products'
+        request_data = {
+            "data": [
+                {
+                    "type": "product",
+                    "id": product_id
+                }
+                for product_id in products_ids
+            ]
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_product_node_relationship')
+
+    async def iter_products(self, concurrent: bool = False) -> AsyncIterator[dict]:
+        url = f'{self.api_url}/pcm/products'
+        async for page in self._iter_pages(url, endpoint='get_products', concurrent=concurrent):
+            for product in page['data']:
+                yield product
+
+    async def get_products(self, concurrent: bool = False) -> dict:
+        return {'data': [product async for product in self.iter_products(concurrent=concurrent)]}
+
+    async def iter_products_in_release(self,
+                                       catalog_id: str = None,
+                                       node_id: str = None,
+                                       release_id: str = 'latest',
+                                       concurrent: bool = False) -> AsyncIterator[dict]:
+        catalog_id = catalog_id or self.catalog_id
+        node_id = node_id or self.node_id
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}/releases/{release_id}/nodes/{node_id}/relationships/products'
+        async for page in self._iter_pages(url, endpoint='fetch_products_in_release', concurrent=concurrent):
+            for product in page['data']:
+                yield product
+
+    async def get_products_in_release(self,
+                                      catalog_id: str = None,
+                                      node_id: str = None,
+                                      release_id: str = 'latest') -> dict:
+        products = self.iter_products_in_release(
+            catalog_id=catalog_id,
+            node_id=node_id,
+            release_id=release_id,
+            concurrent=True
+        )
+        return {'data': [product async for product in products]}
+
+    async def get_pricebook(self, pricebook_id: str = None, include_prices: bool = True) -> dict:
+        url = f'{self.api_url}/pcm/pricebooks/{pricebook_id or self.pricebook_id}'
+        params = {"include": "prices"} if include_prices else {}
+        return await self._request('GET', url, params=params, endpoint='get_pricebook')
+
+    async def create_pricebook(self, pricebook_name: str, pricebook_description: str = '') -> dict:
+        url = f'{self.api_url}/pcm/pricebooks'
+        request_data = {
+            "data": {
+                "type": "pricebook",
+                "attributes": {
+                    "name": pricebook_name,
+                    "description": pricebook_description
+                }
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_pricebook')
+
+    async def create_product_price(self, pricebook_id: str, price_meta: dict) -> dict:
+        url = f'{self.api_url}/pcm/pricebooks/{pricebook_id}/prices'
+        price = await self._request('POST', url, json=price_meta, endpoint='create_product_price')
+        version_key, _ = Motlin._price_index_keys(pricebook_id)
+        if await self.redis.exists(version_key):
+            async with self.redis.pipeline() as pipe:
+                Motlin.queue_price_patch(pipe, pricebook_id, price)
+                await pipe.execute()
+        return price
+
+    async def add_file(self, image_url: str) -> dict:
+        url = f'{self.api_url}/v2/files'
+        with aiohttp.MultipartWriter('form-data') as form:
+            part = form.append(image_url)
+            part.set_content_disposition('form-data', name='file_location')
+        return await self._request('POST', url, data=form, endpoint='add_file')
+
+    async def link_prod_and_image(self, product_id: str, image_id: str) -> None:
+        url = f'{self.api_url}/pcm/products/{product_id}/relationships/main_image'
+        request_data = {
+            "data": {
+                "type": "file",
+                "id": image_id
+            }
+        }
+        await self._request('POST', url, json=request_data, endpoint='link_prod_and_image')
+        async with self.redis.pipeline() as pipe:
+            Motlin.queue_photo_invalidation(pipe, product_id)
+            await pipe.execute()
+
+    async def get_flow(self, flow_id: str = None) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_id or self.flow_id}'
+        return await self._request('GET', url, endpoint='get_flow')
+
+    async def create_flow(self,
+                          name: str,
+                          description: str,
+                          slug: str,
+                          enabled: bool = True) -> dict:
+        url = f'{self.api_url}/v2/flows'
+        request_data = {
+            "data": {
+                "type": "flow",
+                "name": name,
+                "description": description,
+                "slug": slug,
+                "enabled": enabled
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_flow')
+
+    async def get_flow_fields(self, flow_slug: str) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/fields'
+        return await self._request('GET', url, endpoint='get_flow_fields')
+
+    async def create_field(self,
+                           name: str,
+                           slug: str,
+                           field_type: str,
+                           description: str,
+                           flow_id: str,
+                           required: bool = True,
+                           enabled: bool = True) -> dict:
+        url = f'{self.api_url}/v2/fields'
+        request_data = {
+            "data": {
+                "type": "field",
+                "name": name,
+                "slug": slug,
+                "field_type": field_type,
+                "description": description,
+                "required": required,
+                "enabled": enabled,
+                "relationships": {
+                    "flow": {
+                        "data": {
+                            "type": "flow",
+                            "id": flow_id
+                        }
+                    }
+                }
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_field')
+
+    async def iter_entries(self, flow_slug: str, concurrent: bool = False) -> AsyncIterator[dict]:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries'
+        async for page in self._iter_pages(url, endpoint='get_entries', concurrent=concurrent):
+            for entry in page['data']:
+                yield entry
+
+    async def get_entries(self, flow_slug: str, concurrent: bool = False) -> list:
+        return [entry async for entry in self.iter_entries(flow_slug=flow_slug, concurrent=concurrent)]
+
+    async def get_entry(self, flow_slug: str, entry_id: str) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries/{entry_id}'
+        return await self._request('GET', url, endpoint='get_entry')
+
+    async def create_entry(self,
+                           flow_slug: str,
+                           address: str,
+                           alias: str,
+                           longitude: float,
+                           latitude: float) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries'
+        request_data = {
+            "data": {
+                "type": "entry",
+                "address": address,
+                "alias": alias,
+                "longitude": longitude,
+                "latitude": latitude
+            }
+        }
+        return await self._request('POST', url, json=request_data, endpoint='create_entry')
+
+    async def update_entry(self,
+                           flow_slug: str,
+                           entry_id: str,
+                           field_slug: str,
+                           field_value: str) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries/{entry_id}'
+        request_data = {
+            "data": {
+                "type": "entry",
+                "id": entry_id,
+                field_slug: field_value,
+            }
+        }
+        return await self._request('PUT', url, json=request_data, endpoint='update_entry')
+
+    async def create_cart(self, name: str = None) -> dict:
+        url = f'{self.api_url}/v2/carts'
+        post_data = {
+            "data": {
+                "name": name or f'{int(datetime.now().timestamp())}_cart',
+            }
+        }
+        return await self._request('POST', url, json=post_data, endpoint='create_cart')
+
+    async def _update_session(self, user_telegram_id: int, **fields) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(session_key(user_telegram_id), mapping=fields)
+            pipe.expire(session_key(user_telegram_id), self.session_ttl)
+            await pipe.execute()
+
+    async def _get_cart_id(self, user_telegram_id: int, session: UserSession = None) -> str:
+        # same session hash and the same rules as Motlin._create_or_refresh_cart
+        if session is not None:
+            cart_id, cart_expired = session.get('cart_id'), session.get('cart_expired')
+        else:
+            cart_id, cart_expired = await self.redis.hmget(
+                session_key(user_telegram_id),
+                'cart_id',
+                'cart_expired'
+            )
+        if not (cart_id and cart_expired) or \
+            datetime.now().timestamp() + self.EXPIRED_SPARE_TIME > int(cart_expired):
+            new_cart = await self.create_cart()
+
+            expired_at = new_cart['data']['meta']['timestamps']['expires_at']
+            datetime_obj = datetime.fromisoformat(expired_at + '+03:00')
+
+            cart_fields = {
+                'cart_id': new_cart['data']['id'],
+                'cart_expired': int(datetime_obj.timestamp()),
+            }
+            await self._update_session(user_telegram_id, **cart_fields)
+            if session is not None:
+                session.update(cart_fields)
+            cart_id = cart_fields['cart_id']
+        return cart_id
+
+    async def delete_cart(self, cart_id: str) -> None:
+        url = f'{self.api_url}/v2/carts/{cart_id}'
+        await self._request('DELETE', url, endpoint='delete_cart')
+
+    async def add_product_to_cart(self,
+                                  user_telegram_id: int,
+                                  product_id: str,
+                                  quantity: int,
+                                  session: UserSession = None) -> dict:
+        cart_id = await self._get_cart_id(user_telegram_id, session)
+        url = f'{self.api_url}/v2/carts/{cart_id}/items'
+        post_data = {
+            "data": {
+                "id": product_id,
+                "type": 'cart_item',
+                'quantity': quantity
+            }
+        }
+        return await self._request('POST', url, json=post_data, endpoint='add_product_to_cart')
+
+    async def get_cart(self, user_telegram_id: int, session: UserSession = None) -> dict:
+        cart_id = await self._get_cart_id(user_telegram_id, session)
+        url = f'{self.api_url}/v2/carts/{cart_id}'
+        params = {
+            "include": "items",
+        }
+        return await self._request('GET', url, params=params, endpoint='get_cart')
+
+    async def remove_product_from_cart(self,
+                                       user_telegram_id: int,
+                                       item_id: str,
+                                       session: UserSession = None) -> dict:
+        cart_id = await self._get_cart_id(user_telegram_id, session)
+        url = f'{self.api_url}/v2/carts/{cart_id}/items/{item_id}'
+        return await self._request('DELETE', url, endpoint='remove_product_from_cart')
+
+    async def create_customer(self,
+                              name: str,
+                              email: str,
+                              user_telegram_id: int) -> dict:
+        url = f'{self.api_url}/v2/customers'
+        post_data = {
+            "data": {
+                "type": "customer",
+                "name": name,
+                "email": email,
+            }
+        }
+        response_meta = await self._request('POST', url, json=post_data, endpoint='create_customer')
+        await self._update_session(user_telegram_id, customer_id=response_meta['data']['id'])
+        return response_meta
+
+    async def update_customer_address(self,
+                                      customer_id: str,
+                                      longitude: float,
+                                      latitude: float) -> dict:
+        url = f'{self.api_url}/v2/customers/{customer_id}'
+        put_data = {
+            "data": {
+                "type": "customer",
+                "longitude": longitude,
+                "latitude": latitude
+            }
+        }
+        return await self._request('PUT', url, json=put_data, endpoint='update_customer_address')
+
+    async def get_customer(self, customer_id: str) -> dict:
+        url = f'{self.api_url}/v2/customers/{customer_id}'
+        return await self._request('GET', url, endpoint='get_customer')
@@ -0,0 +1,367 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+import warnings
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from queue import Queue
+
+from geopy.distance import geodesic
+from telegram import Bot, Update
+from telegram.ext import TypeHandler
+from telegram.ext.jobqueue import JobQueue
+
+from chat_dispatcher import ChatOrderedDispatcher
+from geo_distances import PizzeriaDistances
+from motlin import Motlin
+from sharded_bot import STOP, HashRing, ShardedUpdateQueue, feed_dispatcher
+from webhook import SECRET_TOKEN_HEADER, start_webhook_server
+
+APP_DESCRIPTION = 'Latency benchmarks against a local stand-in of the Moltin API'
+
+FAKE_TOKEN_LIFETIME = 60 * 60
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    handshake_delay = 0.0
+    response_delay = 0.0
+
+    def setup(self):
+        # every new TCP connection pays the simulated TCP+TLS handshake once
+        time.sleep(self.handshake_delay)
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length:
+            self.rfile.read(content_length)
+        if self.path.startswith('/oauth/access_token'):
+            payload = {
+                'access_token': 'stand-in-token',
+                'expires': int(time.time()) + FAKE_TOKEN_LIFETIME,
+            }
+        else:
+            payload = {'data': {'id': 'stand-in', 'attributes': {}}, 'included': {}}
+        time.sleep(self.response_delay)
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _answer
+
+
+def start_stand_in_server(handshake_delay: float, response_delay: float) -> ThreadingHTTPServer:
+    handler = type(
+        'ConfiguredStandInHandler',
+        (StandInHandler,),
+        {'handshake_delay': handshake_delay, 'response_delay': response_delay}
+    )
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_stand_in_motlin(api_url: str, **kwargs) -> Motlin:
+    # throttling would hide the difference we want to measure
+    kwargs.setdefault('rate_limit', None)
+    return Motlin(
+        'client_id',
+        'client_secret',
+        'catalog_id',
+        'node_id',
+        'pricebook_id',
+        'flow_id',
+        api_url=api_url,
+        **kwargs
+    )
+
+
+def describe_latencies(title: str, latencies: list) -> str:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    return (
+        f'{title:<12} mean {statistics.mean(latencies) * 1000:7.2f} ms   '
+        f'p50 {statistics.median(latencies) * 1000:7.2f} ms   '
+        f'p95 {p95 * 1000:7.2f} ms'
+    )
+
+
+def benchmark_session(args) -> None:
+    server = start_stand_in_server(args.handshake_ms / 1000, args.response_ms / 1000)
+    api_url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        for title, keep_alive in (('no pooling', False), ('pooled', True)):
+            motlin_api = make_stand_in_motlin(api_url, keep_alive=keep_alive)
+            latencies = list()
+            for _ in range(args.requests):
+                started_at = time.perf_counter()
+                motlin_api.get_product(product_id='stand-in')
+                latencies.append(time.perf_counter() - started_at)
+            motlin_api.close()
+            print(describe_latencies(title, latencies))
+    finally:
+        server.shutdown()
+
+
+def make_random_points(count: int, center: tuple, spread: float) -> list:
+    return [
+        (center[0] + random.uniform(-spread, spread), center[1] + random.uniform(-spread, spread))
+        for _ in range(count)
+    ]
+
+
+def benchmark_distances(args) -> None:
+    random.seed(args.seed)
+    moscow = (55.75, 37.62)
+    pizzerias = [
+        {'id': str(index), 'latitude': latitude, 'longitude': longitude}
+        for index, (latitude, longitude) in enumerate(make_random_points(args.pizzerias, moscow, 0.3))
+    ]
+    customers = make_random_points(args.customers, moscow, 0.4)
+
+    # the way enter_location used to do it: geodesic to every pizzeria, sort, take first
+    started_at = time.perf_counter()
+    loop_nearest = list()
+    for customer in customers:
+        distances = sorted(
+            (geodesic(customer, (pizzeria['latitude'], pizzeria['longitude'])).km, pizzeria['id'])
+            for pizzeria in pizzerias
+        )
+        loop_nearest.append(distances[0])
+    loop_duration = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    pizzeria_distances = PizzeriaDistances(pizzerias)
+    latitudes, longitudes = zip(*customers)
+    indexes, distances = pizzeria_distances.nearest(latitudes, longitudes)
+    vectorized_duration = time.perf_counter() - started_at
+
+    same_nearest = sum(
+        loop_id == pizzerias[index]['id']
+        for (_, loop_id), index in zip(loop_nearest, indexes)
+    )
+    max_error = max(abs(loop_distance - distance) for (loop_distance, _), distance in zip(loop_nearest, distances))
+    print(f'geopy loop   {loop_duration * 1000:9.2f} ms')
+    print(f'vectorized   {vectorized_duration * 1000:9.2f} ms   x{loop_duration / vectorized_duration:.0f}')
+    print(f'same nearest pizzeria for {same_nearest} of {len(customers)} customers, max distance error {max_error * 1000:.1f} m')
+
+
+def make_synthetic_update(update_id: int, chat_id: int) -> bytes:
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            'text': 'benchmark',
+        },
+    }).encode()
+
+
+def benchmark_webhook(args) -> None:
+    secret_token = 'benchmark-secret'
+    # never goes to Telegram, the handler only sleeps
+    warnings.filterwarnings('ignore', 'Asynchronous callbacks')
+    bot = Bot(token='123456:benchmark')
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(maxsize=args.queue_size),
+        job_queue=job_queue,
+        # no run_async pool, its thread names would call getMe
+        workers=0,
+        chat_workers=args.workers,
+        max_pending=args.queue_size
+    )
+    processed = threading.Semaphore(0)
+
+    def handle_update(update, context):
+        time.sleep(args.handler_ms / 1000)
+        processed.release()
+
+    dispatcher.add_handler(TypeHandler(Update, handle_update))
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    server = start_webhook_server(dispatcher.update_queue, bot, 0, secret_token, host='127.0.0.1')
+
+    statuses, latencies, lock = dict(), list(), threading.Lock()
+
+    def post_updates(client: int):
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        for number in range(client, args.updates, args.clients):
+            started_at = time.perf_counter()
+            connection.request('POST', '/telegram', body=make_synthetic_update(number, number % args.chats), headers={
+                'Content-Type': 'application/json',
+                SECRET_TOKEN_HEADER: secret_token,
+            })
+            response = connection.getresponse()
+            response.read()
+            with lock:
+                latencies.append(time.perf_counter() - started_at)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        connection.close()
+
+    started_at = time.perf_counter()
+    clients = [threading.Thread(target=post_updates, args=(client,)) for client in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    ingested_at = time.perf_counter()
+    for _ in range(statuses.get(200, 0)):
+        processed.acquire()
+    finished_at = time.perf_counter()
+    dispatcher.stop()
+    server.shutdown()
+
+    accepted = statuses.get(200, 0)
+    print(describe_latencies('webhook ack', latencies))
+    print(f'accepted {accepted} of {args.updates}, rejected with 503: {statuses.get(503, 0)}, other: '
+          f'{sum(count for status, count in statuses.items() if status not in (200, 503))}')
+    print(f'ingested     {args.updates / (ingested_at - started_at):9.0f} updates/s')
+    print(f'processed    {accepted / (finished_at - started_at):9.0f} updates/s')
+
+
+def burn_cpu(seconds: float) -> None:
+    # stands in for the CPU part of a handler: JSON, rendering, telegram objects
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def run_benchmark_shard(shard_queue, processed_queue, chat_workers: int, handler_ms: float) -> None:
+    warnings.filterwarnings('ignore', 'Asynchronous callbacks')
+    bot = Bot(token='123456:benchmark')
+    dispatcher = ChatOrderedDispatcher(bot, Queue(maxsize=100), workers=0, chat_workers=chat_workers, max_pending=100)
+    processed = [0]
+
+    def handle_update(update, context):
+        burn_cpu(handler_ms / 1000)
+        processed[0] += 1
+
+    dispatcher.add_handler(TypeHandler(Update, handle_update))
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    # ready, spawning and imports are not part of the measurement
+    processed_queue.put(None)
+    feed_dispatcher(shard_queue, dispatcher)
+    dispatcher.stop()
+    processed_queue.put(processed[0])
+
+
+def get_remapped_share(shards: int, chats: int = 100000) -> float:
+    ring, bigger_ring = HashRing(range(shards)), HashRing(range(shards + 1))
+    return sum(ring.get_shard(chat) != bigger_ring.get_shard(chat) for chat in range(chats)) / chats
+
+
+def benchmark_sharded(args) -> None:
+    context = multiprocessing.get_context('spawn')
+    bot = Bot(token='123456:benchmark')
+    updates = [
+        Update.de_json(json.loads(make_synthetic_update(number, number % args.chats)), bot)
+        for number in range(args.updates)
+    ]
+    single_process_rate = None
+    for shards in range(1, args.max_shards + 1):
+        shard_queues = [context.Queue(maxsize=1000) for _ in range(shards)]
+        processed_queue = context.Queue()
+        processes = [
+            context.Process(
+                target=run_benchmark_shard,
+                args=(shard_queue, processed_queue, args.workers, args.handler_ms)
+            )
+            for shard_queue in shard_queues
+        ]
+        for process in processes:
+            process.start()
+        update_queue = ShardedUpdateQueue(shard_queues, HashRing(range(shards)))
+        for _ in processes:
+            processed_queue.get()
+        started_at = time.perf_counter()
+        for update in updates:
+            update_queue.put(update)
+        for shard_queue in shard_queues:
+            shard_queue.put(STOP)
+        processed = sum(processed_queue.get() for _ in processes)
+        duration = time.perf_counter() - started_at
+        for process in processes:
+            process.join()
+        rate = processed / duration
+        single_process_rate = single_process_rate or rate
+        print(
+            f'{shards:>2} shards  {rate:9.0f} updates/s   x{rate / single_process_rate:.2f}   '
+            f'chats moved by one more shard: {get_remapped_share(shards):.0%} (ideal {1 / (shards + 1):.0%})'
+        )
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    session_parser = subparsers.add_parser(
+        'session',
+        help='Fresh connection per call vs pooled keep-alive session'
+    )
+    session_parser.add_argument('--requests', type=int, default=200)
+    session_parser.add_argument(
+        '--handshake_ms',
+        type=float,
+        default=30,
+        help='Simulated TCP+TLS handshake cost of a new connection'
+    )
+    session_parser.add_argument('--response_ms', type=float, default=5)
+    session_parser.set_defaults(func=benchmark_session)
+
+    distances_parser = subparsers.add_parser(
+        'distances',
+        help='Per-pizzeria geopy loop vs vectorized haversine for a batch of customers'
+    )
+    distances_parser.add_argument('--pizzerias', type=int, default=200)
+    distances_parser.add_argument('--customers', type=int, default=100)
+    distances_parser.add_argument('--seed', type=int, default=0)
+    distances_parser.set_defaults(func=benchmark_distances)
+
+    webhook_parser = subparsers.add_parser(
+        'webhook',
+        help='Synthetic updates POSTed to the webhook server, handlers only sleep'
+    )
+    webhook_parser.add_argument('--updates', type=int, default=2000)
+    webhook_parser.add_argument('--clients', type=int, default=8, help='Parallel HTTP connections')
+    webhook_parser.add_argument('--chats', type=int, default=100)
+    webhook_parser.add_argument('--workers', type=int, default=8)
+    webhook_parser.add_argument('--queue_size', type=int, default=1000)
+    webhook_parser.add_argument('--handler_ms', type=float, default=5)
+    webhook_parser.set_defaults(func=benchmark_webhook)
+
+    sharded_parser = subparsers.add_parser(
+        'sharded',
+        help='Updates routed by chat id to 1..N worker processes with CPU-bound handlers'
+    )
+    sharded_parser.add_argument('--updates', type=int, default=4000)
+    sharded_parser.add_argument('--chats', type=int, default=500)
+    sharded_parser.add_argument('--max_shards', type=int, default=multiprocessing.cpu_count())
+    sharded_parser.add_argument('--workers', type=int, default=4, help='Chat workers per process')
+    sharded_parser.add_argument('--handler_ms', type=float, default=1)
+    sharded_parser.set_defaults(func=benchmark_sharded)
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from metrics import Metrics
+
+# waits of a chat behind its own previous updates and behind busy workers
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def get_chat_key(update: Update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        # pre checkout queries have a user only, the user's chat is the same id
+        return update.effective_user.id
+    return None
+
+
+def describe_update(update: Update) -> str:
+    # handler label of the metrics, bounded: callback data up to the first ':'
+    if update.callback_query:
+        return f'callback:{(update.callback_query.data or "").split(":")[0]}'
+    if update.pre_checkout_query:
+        return 'pre_checkout_query'
+    if update.message:
+        if update.message.successful_payment:
+            return 'successful_payment'
+        if update.message.text and update.message.text.startswith('/'):
+            return 'command'
+        if update.message.location:
+            return 'location'
+        return 'message'
+    return 'other'
+
+
+class ChatOrderedExecutor:
+    # Runs tasks on a thread pool, tasks of one chat strictly one after
+    # another in submission order, different chats in parallel. With
+    # max_pending, submit blocks while that many tasks are waiting.
+
+    def __init__(self, max_workers: int, metrics: Metrics = None, max_pending: int = 0) -> ChatOrderedExecutor:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-worker')
+        self.metrics = metrics
+        self.max_pending = max_pending
+        self.lock = threading.Condition()
+        # chat key -> deque of (task, label, enqueued_at), present while the chat has work
+        self.chat_queues = dict()
+        self.queue_depth = 0
+
+    def _set_depth_gauges(self) -> None:
+        if self.metrics is not None:
+            self.metrics.set_gauge('queue_depth', {}, self.queue_depth)
+            self.metrics.set_gauge('busy_chats', {}, len(self.chat_queues))
+
+    def submit(self, chat_key, task: Callable, label: str = 'other') -> None:
+        with self.lock:
+            if self.max_pending:
+                self.lock.wait_for(lambda: self.queue_depth < self.max_pending)
+            chat_queue = self.chat_queues.get(chat_key)
+            is_idle_chat = chat_queue is None
+            if is_idle_chat:
+                chat_queue = self.chat_queues[chat_key] = deque()
+            chat_queue.append((task, label, time.monotonic()))
+            self.queue_depth += 1
+            self._set_depth_gauges()
+        if is_idle_chat:
+            self.executor.submit(self._run_next, chat_key)
+
+    def _run_next(self, chat_key) -> None:
+        with self.lock:
+            task, label, enqueued_at = self.chat_queues[chat_key].popleft()
+            self.queue_depth -= 1
+            self._set_depth_gauges()
+            self.lock.notify()
+        started_at = time.monotonic()
+        try:
+            task()
+        except Exception:
+            logger.exception('Update of chat %s failed', chat_key)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('handler_wait_seconds', {'handler': label}, started_at - enqueued_at, WAIT_BUCKETS)
+                self.metrics.observe('handler_duration_seconds', {'handler': label}, time.monotonic() - started_at)
+                self.metrics.inc('updates_total', {'handler': label})
+            with self.lock:
+                has_more = bool(self.chat_queues[chat_key])
+                if not has_more:
+                    del self.chat_queues[chat_key]
+                    self._set_depth_gauges()
+        if has_more:
+            # back of the pool queue, a busy chat does not starve the others
+            self.executor.submit(self._run_next, chat_key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    # process_update of each chat runs on ChatOrderedExecutor instead of the
+    # single dispatcher thread, so a slow Moltin call holds up its own chat only.
+    # max_pending keeps updates in the update queue once the workers fall behind,
+    # so a bounded update queue fills up and the webhook can push back.
+
+    def __init__(self,
+                 *args,
+                 chat_workers: int = 8,
+                 metrics: Metrics = None,
+                 max_pending: int = 0,
+                 **kwargs) -> ChatOrderedDispatcher:
+        super().__init__(*args, **kwargs)
+        self.chat_executor = ChatOrderedExecutor(chat_workers, metrics, max_pending)
+
+    def process_update(self, update) -> None:
+        if not isinstance(update, Update):
+            # errors and custom updates put into the queue
+            super().process_update(update)
+            return
+        self.chat_executor.submit(
+            get_chat_key(update),
+            lambda: super(ChatOrderedDispatcher, self).process_update(update),
+            describe_update(update)
+        )
+
+    def stop(self) -> None:
+        super().stop()
+        self.chat_executor.shutdown()
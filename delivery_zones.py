@@ -0,0 +1,222 @@
+from __future__ import annotations
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from geopy.distance import geodesic
+from redis.exceptions import LockError, WatchError
+
+from geo_distances import DEFAULT_BOUNDARY_TOLERANCE, DELIVERY_TIERS, PizzeriaDistances, get_delivery_tier
+from motlin import Motlin
+
+KM_PER_LATITUDE_DEGREE = 111.2
+BOUNDARY_CELL = '*'
+NO_TIER = '-'  # out of range cells of maps built before they were skipped
+
+logger = logging.getLogger(__name__)
+
+
+def zones_key(flow_id: str) -> str:
+    # lives next to the pizzerias registry, Motlin.invalidate_pizzerias drops it too
+    return f'motlin:flow:{flow_id}:pizzerias:zones'
+
+
+def generation_key(flow_id: str) -> str:
+    # changed by Motlin.invalidate_pizzerias
+    return f'motlin:flow:{flow_id}:pizzerias:generation'
+
+
+class DeliveryZones:
+    # Lat/lon grid cell -> nearest pizzeria and delivery tier, stored in one
+    # redis hash. Only cells within the largest tier of some pizzeria are kept.
+    # Cells crossed by a tier bound or shared by two pizzerias are marked as
+    # boundary cells and resolved exactly, like cells outside the map.
+    CELL_SIZE = 0.005  # degrees, ~550 m of latitude
+    BUILD_BATCH_SIZE = 2000
+    WRITE_BATCH_SIZE = 5000
+
+    def __init__(self,
+                 motlin_api: Motlin,
+                 cell_size: float = CELL_SIZE,
+                 flow_id: str = None) -> DeliveryZones:
+        self.motlin_api = motlin_api
+        self.redis = motlin_api.redis
+        self.cell_size = cell_size
+        self.flow_id = flow_id or motlin_api.flow_id
+        self.zones_key = zones_key(self.flow_id)
+        self.generation_key = generation_key(self.flow_id)
+        self.version = None
+        self.pizzerias_by_id = dict()
+        self.build_thread = None
+
+    def get_cell(self, latitude: float, longitude: float) -> str:
+        return f'{math.floor(latitude / self.cell_size)}:{math.floor(longitude / self.cell_size)}'
+
+    def build(self) -> dict:
+        # read before the pizzerias, so an invalidation during the build is noticed
+        generation = self.redis.get(self.generation_key)
+        pizzerias = self.motlin_api.get_pizzerias(flow_id=self.flow_id)['entries']
+        if not pizzerias:
+            return {'cells': 0, 'boundary_cells': 0}
+        distances = PizzeriaDistances(pizzerias)
+        cells_latitudes, cells_longitudes = self._get_candidate_cells(distances)
+        # a longitude degree is never longer than a latitude one
+        half_diagonal_km = self.cell_size * KM_PER_LATITUDE_DEGREE / math.sqrt(2)
+        tier_bounds = np.array([tier[0] for tier in DELIVERY_TIERS])
+
+        version = str(time.time())
+        building_key = f'{self.zones_key}:building'
+        self.redis.delete(building_key)
+        self.redis.hset(building_key, 'version', version)
+        cells_count, boundary_cells_count = 0, 0
+        for start in range(0, len(cells_latitudes), self.BUILD_BATCH_SIZE):
+            batch_latitudes = cells_latitudes[start:start + self.BUILD_BATCH_SIZE]
+            batch_longitudes = cells_longitudes[start:start + self.BUILD_BATCH_SIZE]
+            centers = distances.haversine_matrix(
+                (batch_latitudes + 0.5) * self.cell_size,
+                (batch_longitudes + 0.5) * self.cell_size
+            )
+            nearest = centers.argmin(axis=1)
+            nearest_distances = centers[np.arange(len(nearest)), nearest]
+            if len(pizzerias) > 1:
+                second_distances = np.partition(centers, 1, axis=1)[:, 1]
+            else:
+                second_distances = np.full(len(nearest), np.inf)
+            uncertainty = half_diagonal_km + nearest_distances * DEFAULT_BOUNDARY_TOLERANCE
+            is_uniform = (
+                (np.searchsorted(tier_bounds, nearest_distances - uncertainty)
+                 == np.searchsorted(tier_bounds, nearest_distances + uncertainty))
+                & (second_distances - nearest_distances > 2 * uncertainty)
+            )
+            tiers = np.searchsorted(tier_bounds, nearest_distances)
+
+            cells = dict()
+            for cell_latitude, cell_longitude, pizzeria, tier, uniform in zip(
+                    batch_latitudes, batch_longitudes, nearest, tiers, is_uniform):
+                if uniform and tier == len(DELIVERY_TIERS):
+                    # out of range, missing cells are resolved exactly
+                    continue
+                cell = f'{cell_latitude}:{cell_longitude}'
+                if not uniform:
+                    cells[cell] = BOUNDARY_CELL
+                    boundary_cells_count += 1
+                else:
+                    cells[cell] = f'{pizzerias[pizzeria]["id"]} {tier}'
+            cells_count += len(cells)
+            with self.redis.pipeline(transaction=False) as pipe:
+                cells = list(cells.items())
+                for write_start in range(0, len(cells), self.WRITE_BATCH_SIZE):
+                    pipe.hset(building_key, mapping=dict(cells[write_start:write_start + self.WRITE_BATCH_SIZE]))
+                pipe.execute()
+
+        # readers switch to the complete map at once, unless the pizzerias
+        # were invalidated meanwhile - then the map is stale and is dropped
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.generation_key)
+                is_current = pipe.get(self.generation_key) == generation
+                if is_current:
+                    pipe.multi()
+                    pipe.rename(building_key, self.zones_key)
+                    pipe.expire(self.zones_key, self.motlin_api.PIZZERIAS_CACHE_TTL)
+                    pipe.execute()
+            except WatchError:
+                is_current = False
+        if not is_current:
+            self.redis.delete(building_key)
+            logger.info('Delivery zones build discarded, pizzerias were changed during it')
+            return {'cells': 0, 'boundary_cells': 0}
+        logger.info('Delivery zones built: %s cells, %s boundary', cells_count, boundary_cells_count)
+        return {'cells': cells_count, 'boundary_cells': boundary_cells_count}
+
+    def _get_candidate_cells(self, distances: PizzeriaDistances) -> tuple[np.ndarray]:
+        # union of the squares around every pizzeria that cover its largest
+        # tier, so the map grows with the delivery area, not with the bounding box
+        margin_km = DELIVERY_TIERS[-1][0] * 1.1
+        margin_latitude = margin_km / KM_PER_LATITUDE_DEGREE
+        squares = list()
+        for latitude, longitude in zip(distances.latitudes, distances.longitudes):
+            max_abs_latitude = min(abs(float(latitude)) + margin_latitude, 89)
+            margin_longitude = margin_km / (KM_PER_LATITUDE_DEGREE * math.cos(math.radians(max_abs_latitude)))
+            latitude_cells = np.arange(
+                math.floor((latitude - margin_latitude) / self.cell_size),
+                math.floor((latitude + margin_latitude) / self.cell_size) + 1
+            )
+            longitude_cells = np.arange(
+                math.floor((longitude - margin_longitude) / self.cell_size),
+                math.floor((longitude + margin_longitude) / self.cell_size) + 1
+            )
+            square = np.meshgrid(latitude_cells, longitude_cells, indexing='ij')
+            squares.append(np.column_stack([grid.ravel() for grid in square]))
+        cells = np.unique(np.concatenate(squares), axis=0)
+        return cells[:, 0], cells[:, 1]
+
+    def _build_in_background(self) -> None:
+        if self.build_thread and self.build_thread.is_alive():
+            return
+
+        def build_once():
+            lock = self.redis.lock(f'{self.zones_key}:build_lock', timeout=10 * 60)
+            if not lock.acquire(blocking=False):
+                return
+            try:
+                self.build()
+            except Exception:
+                logger.exception('Delivery zones build failed')
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+        self.build_thread = threading.Thread(target=build_once, name='delivery-zones-build', daemon=True)
+        self.build_thread.start()
+
+    def _get_pizzeria(self, pizzeria_id: str, version: str) -> dict | None:
+        if version != self.version:
+            pizzerias = self.motlin_api.get_pizzerias(flow_id=self.flow_id)['entries']
+            self.pizzerias_by_id = {pizzeria['id']: pizzeria for pizzeria in pizzerias}
+            self.version = version
+        return self.pizzerias_by_id.get(pizzeria_id)
+
+    def _resolve_exactly(self, latitude: float, longitude: float) -> dict | None:
+        nearest_pizzerias = self.motlin_api.find_nearest_pizzerias(
+            longitude=longitude,
+            latitude=latitude,
+            flow_id=self.flow_id
+        )
+        if not nearest_pizzerias:
+            return None
+        pizzeria = nearest_pizzerias[0]
+        return {
+            'pizzeria': pizzeria,
+            'distance': pizzeria['distance'],
+            'tier': get_delivery_tier(pizzeria['distance']),
+        }
+
+    def resolve(self, latitude: float, longitude: float) -> dict | None:
+        # {'pizzeria': entry, 'distance': km, 'tier': (bound km, price) or None}
+        cell_value, version = self.redis.hmget(self.zones_key, self.get_cell(latitude, longitude), 'version')
+        if version is None:
+            self._build_in_background()
+        if not cell_value or cell_value == BOUNDARY_CELL:
+            # a missing cell is out of range of every pizzeria (or the map is
+            # not built yet), the exact search still finds the nearest one
+            return self._resolve_exactly(latitude, longitude)
+
+        pizzeria_id, tier = cell_value.split(' ')
+        pizzeria = self._get_pizzeria(pizzeria_id, version)
+        if pizzeria is None:
+            return self._resolve_exactly(latitude, longitude)
+        return {
+            'pizzeria': pizzeria,
+            # one geodesic to the known pizzeria, for the distance shown to the customer
+            'distance': geodesic(
+                (latitude, longitude),
+                (float(pizzeria['latitude']), float(pizzeria['longitude']))
+            ).km,
+            'tier': None if tier == NO_TIER else DELIVERY_TIERS[int(tier)],
+        }
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import numpy as np
+
+from geopy.distance import geodesic
+
+EARTH_RADIUS_KM = 6371.0088
+
+# (upper bound in km, delivery price in RUB), the same tiers enter_location offers
+DELIVERY_TIERS = ((0.5, 0), (5, 100), (20, 200))
+
+# haversine is off by up to ~0.5% against the WGS-84 ellipsoid
+DEFAULT_BOUNDARY_TOLERANCE = 0.005
+
+
+def haversine_km(latitudes, longitudes, other_latitudes, other_longitudes) -> np.ndarray:
+    # all arguments in degrees, broadcast like numpy arrays
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    other_latitudes, other_longitudes = np.radians(other_latitudes), np.radians(other_longitudes)
+    half_chord = (
+        np.sin((other_latitudes - latitudes) / 2) ** 2
+        + np.cos(latitudes) * np.cos(other_latitudes) * np.sin((other_longitudes - longitudes) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(half_chord, 0, 1)))
+
+
+def get_delivery_tier(distance_km: float) -> tuple | None:
+    for tier in DELIVERY_TIERS:
+        if distance_km <= tier[0]:
+            return tier
+    return None
+
+
+class PizzeriaDistances:
+    # Pizzeria coordinates as contiguous arrays, distances from many
+    # customers to all pizzerias at once. Distances close to a delivery
+    # tier bound are recomputed with geodesic, so the tier is always exact,
+    # and so are near ties for the nearest pizzeria.
+
+    def __init__(self,
+                 pizzerias: list[dict],
+                 boundary_tolerance: float = DEFAULT_BOUNDARY_TOLERANCE) -> PizzeriaDistances:
+        self.pizzerias = pizzerias
+        self.latitudes = np.ascontiguousarray([float(pizzeria['latitude']) for pizzeria in pizzerias])
+        self.longitudes = np.ascontiguousarray([float(pizzeria['longitude']) for pizzeria in pizzerias])
+        self.boundary_tolerance = boundary_tolerance
+        self.tier_bounds = np.array([tier[0] for tier in DELIVERY_TIERS])
+
+    def __len__(self) -> int:
+        return len(self.pizzerias)
+
+    def haversine_matrix(self, latitudes, longitudes) -> np.ndarray:
+        # customers x pizzerias
+        latitudes = np.asarray(latitudes, dtype=np.float64).reshape(-1, 1)
+        longitudes = np.asarray(longitudes, dtype=np.float64).reshape(-1, 1)
+        return haversine_km(latitudes, longitudes, self.latitudes, self.longitudes)
+
+    def is_near_tier_bound(self, distances: np.ndarray) -> np.ndarray:
+        gaps = np.abs(distances[..., np.newaxis] - self.tier_bounds)
+        return (gaps <= self.tier_bounds * self.boundary_tolerance).any(axis=-1)
+
+    def _geodesic_km(self, latitude: float, longitude: float, pizzeria: int) -> float:
+        return geodesic((latitude, longitude), (self.latitudes[pizzeria], self.longitudes[pizzeria])).km
+
+    def distance_matrix(self, latitudes, longitudes, exact: bool = True) -> np.ndarray:
+        distances = self.haversine_matrix(latitudes, longitudes)
+        if exact and self.boundary_tolerance:
+            latitudes = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+            longitudes = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+            for customer, pizzeria in zip(*np.nonzero(self.is_near_tier_bound(distances))):
+                distances[customer, pizzeria] = self._geodesic_km(
+                    latitudes[customer],
+                    longitudes[customer],
+                    pizzeria
+                )
+        return distances
+
+    def nearest(self, latitudes, longitudes, exact: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        # index of the nearest pizzeria and the distance to it, per customer
+        distances = self.distance_matrix(latitudes, longitudes, exact)
+        indexes = distances.argmin(axis=1)
+        nearest_distances = distances[np.arange(len(indexes)), indexes]
+        if not (exact and self.boundary_tolerance):
+            return indexes, nearest_distances
+
+        # pizzerias almost as close as the nearest one may be closer on the ellipsoid
+        latitudes = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+        longitudes = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+        is_contender = distances <= (nearest_distances * (1 + 2 * self.boundary_tolerance))[:, np.newaxis]
+        for customer in np.nonzero(is_contender.sum(axis=1) > 1)[0]:
+            contenders = np.nonzero(is_contender[customer])[0]
+            contender_distances = [
+                self._geodesic_km(latitudes[customer], longitudes[customer], pizzeria)
+                for pizzeria in contenders
+            ]
+            best = int(np.argmin(contender_distances))
+            indexes[customer] = contenders[best]
+            nearest_distances[customer] = contender_distances[best]
+        return indexes, nearest_distances
@@ -1,13 +1,64 @@
+from __future__ import annotations
+import argparse
+import csv
+import re
+import threading
+import time
+
+from collections import OrderedDict
+
 import requests
 
+from redis import Redis
+from requests.adapters import HTTPAdapter
+
+from metrics import Metrics
+
+GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
+GEOCODER_TIMEOUT = (3.05, 10)
+
+# spelled out, so "ул. Ленина" and "улица ленина" share one cache entry
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'наб': 'набережная',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'пл': 'площадь',
+    'ш': 'шоссе',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+}
+
+# words that do not tell one address from another
+GAZETTEER_IGNORED_WORDS = {'россия', 'город', 'дом'}
+STREET_TYPES = {'улица', 'проспект', 'переулок', 'набережная', 'бульвар', 'площадь', 'шоссе'}
+HOUSE_PARTS = {'корпус', 'строение'}
+
+APP_DESCRIPTION = 'Local gazetteer of the delivery area built from past geocoder results'
+
+geocoder_session = requests.Session()
+geocoder_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
+def normalize_address(address: str) -> str:
+    address = address.lower().replace('ё', 'е')
+    words = re.split(r'[\s,.;:"«»()]+', address)
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words if word)
+
+
+def fetch_coordinates(apikey, address, session: requests.Session = None):
+    response = (session or geocoder_session).get(GEOCODER_URL, params={
         "geocode": address,
         "apikey": apikey,
         "format": "json",
-    })
+    }, timeout=GEOCODER_TIMEOUT)
     response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
@@ -16,4 +67,177 @@ def fetch_coordinates(apikey, address):
 
     most_relevant = found_places[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
-    return lon, lat
\ No newline at end of file
+    return lon, lat
+
+
+class Gazetteer:
+    # Addresses of the delivery area with their coordinates, resolved
+    # in-process. An address matches only an entry with the same street name,
+    # street type and house: similar looking streets are different places,
+    # anything less than an exact match is left to the geocoder.
+
+    def __init__(self, entries: list) -> Gazetteer:
+        # (street name, house) -> street type -> coordinates
+        self.places = dict()
+        for address, lon, lat in entries:
+            key, street_types = self.get_matching_key(address)
+            if not key[0]:
+                continue
+            self.places.setdefault(key, dict()).setdefault(street_types, (lon, lat))
+
+    def __len__(self) -> int:
+        return sum(len(street_types) for street_types in self.places.values())
+
+    @staticmethod
+    def get_matching_key(address: str) -> tuple:
+        # word order does not matter, house numbers keep their order
+        name_words, street_types, house = list(), list(), list()
+        for word in normalize_address(address).split(' '):
+            if not word or word in GAZETTEER_IGNORED_WORDS:
+                continue
+            if word in STREET_TYPES:
+                street_types.append(word)
+            elif word in HOUSE_PARTS or any(char.isdigit() for char in word):
+                house.append(word)
+            else:
+                name_words.append(word)
+        return (tuple(sorted(name_words)), tuple(house)), tuple(sorted(street_types))
+
+    @classmethod
+    def load(cls, filepath: str) -> Gazetteer:
+        # tab separated: address, longitude, latitude
+        with open(filepath, newline='', encoding='utf-8') as gazetteer_file:
+            return cls([tuple(row) for row in csv.reader(gazetteer_file, delimiter='\t') if len(row) == 3])
+
+    def resolve(self, address: str) -> tuple | None:
+        key, street_types = self.get_matching_key(address)
+        places = self.places.get(key)
+        if not places:
+            return None
+        if street_types:
+            return places.get(street_types)
+        # no street type given - fine as long as every known street of that name agrees
+        coordinates = set(places.values())
+        if len(coordinates) == 1:
+            return coordinates.pop()
+        return None
+
+
+def export_gazetteer(redis: Redis, filepath: str) -> int:
+    # every address the geocoder has found, from the GeocoderCache keys
+    exported = 0
+    with open(filepath, 'w', newline='', encoding='utf-8') as gazetteer_file:
+        writer = csv.writer(gazetteer_file, delimiter='\t')
+        for key in redis.scan_iter('geocoder:address:*', count=1000):
+            coordinates = redis.get(key)
+            if not coordinates:
+                continue
+            writer.writerow((key[len('geocoder:address:'):], *coordinates.split(' ')))
+            exported += 1
+    return exported
+
+
+class GeocoderCache:
+    # fetch_coordinates behind an in-process LRU and redis, both keyed by
+    # the normalized address. Addresses the geocoder does not know are
+    # cached too, for a shorter time.
+    FOUND_TTL = 30 * 24 * 60 * 60
+    NOT_FOUND_TTL = 24 * 60 * 60
+    LRU_SIZE = 1024
+
+    def __init__(self,
+                 apikey: str,
+                 redis: Redis,
+                 lru_size: int = LRU_SIZE,
+                 metrics: Metrics = None,
+                 gazetteer: Gazetteer = None) -> GeocoderCache:
+        self.apikey = apikey
+        self.redis = redis
+        self.gazetteer = gazetteer
+        self.lru_size = lru_size
+        self.metrics = metrics
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _address_key(normalized_address: str) -> str:
+        return f'geocoder:address:{normalized_address}'
+
+    def _get_from_lru(self, normalized_address: str) -> tuple | None:
+        with self.lock:
+            expires_at, coordinates = self.lru.get(normalized_address, (0, None))
+            if time.time() >= expires_at:
+                self.lru.pop(normalized_address, None)
+                return None
+            self.lru.move_to_end(normalized_address)
+            return coordinates
+
+    def _put_to_lru(self, normalized_address: str, coordinates: tuple, ttl: int) -> None:
+        with self.lock:
+            self.lru[normalized_address] = (time.time() + ttl, coordinates)
+            self.lru.move_to_end(normalized_address)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def _count_lookup(self, source: str, coordinates: tuple) -> None:
+        if self.metrics is None:
+            return
+        result = 'not_found' if None in coordinates else 'found'
+        self.metrics.inc('lookups_total', {'source': source, 'result': result})
+
+    def fetch_coordinates(self, address: str) -> tuple:
+        normalized_address = normalize_address(address)
+        if not normalized_address:
+            return None, None
+
+        coordinates = self._get_from_lru(normalized_address)
+        if coordinates is not None:
+            self._count_lookup('memory', coordinates)
+            return coordinates
+
+        if self.gazetteer is not None:
+            coordinates = self.gazetteer.resolve(address)
+            if coordinates is not None:
+                self._count_lookup('gazetteer', coordinates)
+                return coordinates
+
+        cached_coordinates = self.redis.get(self._address_key(normalized_address))
+        if cached_coordinates is not None:
+            # empty value is a cached "not found"
+            coordinates = tuple(cached_coordinates.split(' ')) if cached_coordinates else (None, None)
+            ttl = self.FOUND_TTL if cached_coordinates else self.NOT_FOUND_TTL
+            self._put_to_lru(normalized_address, coordinates, ttl)
+            self._count_lookup('redis', coordinates)
+            return coordinates
+
+        started_at = time.perf_counter()
+        try:
+            coordinates = fetch_coordinates(self.apikey, address)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('request_duration_seconds', {}, time.perf_counter() - started_at)
+        ttl = self.NOT_FOUND_TTL if None in coordinates else self.FOUND_TTL
+        self.redis.set(
+            self._address_key(normalized_address),
+            '' if None in coordinates else ' '.join(coordinates),
+            ex=ttl
+        )
+        self._put_to_lru(normalized_address, coordinates, ttl)
+        self._count_lookup('geocoder', coordinates)
+        return coordinates
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    parser.add_argument(
+        'gazetteer_path',
+        help='Куда сохранить справочник адресов (адрес, долгота, широта через табуляцию)'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    # same redis as the bot, Motlin connects with the defaults too
+    redis = Redis(decode_responses=True)
+    print(f'Exported addresses: {export_gazetteer(redis, args.gazetteer_path)}')
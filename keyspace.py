@@ -0,0 +1,99 @@
+from __future__ import annotations
+import argparse
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+APP_DESCRIPTION = 'Key counts and memory footprint of the bot per redis key family'
+
+# family name -> glob pattern, every key the bot and Motlin write belongs to one of them
+KEY_FAMILIES = {
+    'session': 'session:*',
+    'motlin token': 'motlin:*:token*',
+    'catalog releases': 'motlin:catalog:*',
+    'price index': 'motlin:pricebook:*',
+    'pizzerias': 'motlin:flow:*',
+    'telegram photos': 'motlin:product:*:telegram_photo',
+    'geocoder': 'geocoder:*',
+    'conversations': 'chat:*:state',
+    'scheduled jobs': 'bot:scheduled_jobs',
+    'legacy cart id': '*_cart_id',
+    'legacy cart expired': '*_cart_expired',
+    'legacy customer id': '*_customer_id',
+    'legacy coordinates': '*_cordinates',
+    'legacy nearest pizzeria': '*_nearest_pizzeria_id',
+    'legacy is delivery': '*_is_delivery',
+    'legacy pizzeria admin': 'pizerria_*_admin_id',
+}
+
+SCAN_COUNT = 1000
+
+
+def describe_family(redis: Redis, pattern: str, memory_sample: int = 100) -> dict:
+    # MEMORY USAGE is asked for the first keys only and extrapolated,
+    # so the report stays cheap on a big keyspace.
+    keys_count, keys_without_ttl, sampled_keys, sampled_bytes = 0, 0, 0, 0
+    memory_usage_available = True
+    for keys_batch in _scan_batches(redis, pattern):
+        with redis.pipeline(transaction=False) as pipe:
+            for key in keys_batch:
+                pipe.ttl(key)
+            ttls = pipe.execute()
+        keys_count += len(keys_batch)
+        keys_without_ttl += sum(1 for ttl in ttls if ttl == -1)
+        if not memory_usage_available:
+            continue
+        for key in keys_batch[:max(memory_sample - sampled_keys, 0)]:
+            try:
+                sampled_bytes += redis.memory_usage(key) or 0
+            except ResponseError:
+                # MEMORY is disabled on some managed redis
+                memory_usage_available = False
+                break
+            sampled_keys += 1
+    if not memory_usage_available:
+        estimated_bytes = None
+    else:
+        estimated_bytes = int(sampled_bytes / sampled_keys * keys_count) if sampled_keys else 0
+    return {'keys': keys_count, 'without_ttl': keys_without_ttl, 'bytes': estimated_bytes}
+
+
+def _scan_batches(redis: Redis, pattern: str):
+    cursor = None
+    while cursor != 0:
+        cursor, keys = redis.scan(cursor=cursor or 0, match=pattern, count=SCAN_COUNT)
+        if keys:
+            yield keys
+
+
+def make_report(redis: Redis, memory_sample: int = 100) -> dict:
+    return {
+        family: describe_family(redis, pattern, memory_sample)
+        for family, pattern in KEY_FAMILIES.items()
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [f'{"family":<24}{"keys":>10}{"no ttl":>10}{"memory":>14}']
+    for family, stats in report.items():
+        memory = 'n/a' if stats['bytes'] is None else f'{stats["bytes"] / 1024:.1f} KiB'
+        lines.append(f'{family:<24}{stats["keys"]:>10}{stats["without_ttl"]:>10}{memory:>14}')
+    return '\n'.join(lines)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    parser.add_argument(
+        '--memory_sample',
+        type=int,
+        default=100,
+        help='Сколько ключей каждого семейства замерять через MEMORY USAGE'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    # same redis as the bot, Motlin connects with the defaults too
+    redis = Redis(decode_responses=True)
+    print(format_report(make_report(redis, args.memory_sample)))
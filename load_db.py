@@ -1,10 +1,15 @@
+from __future__ import annotations
 import argparse
 import json
 import os
 import re
 import sys
+import threading
+import time
 import requests
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from hashlib import md5
 
@@ -24,6 +29,8 @@ EXAMPLE_MENU_FILENAME = 'menu.json'
 
 EXAMPLE_ADDRESSES_FILENAME = 'addresses.json'
 
+SKU_EXISTS_ERROR_DETAIL = 'sku must be unique amongst products'
+
 DEFAULT_FLOW_FIELDS = set(
     (
         ('address', 'string'),
@@ -81,6 +88,17 @@ def create_parser():
         type=str,
         help=f'Название нового прайс-листа'
     )
+    parser.add_argument(
+        '--publish',
+        action='store_true',
+        help='Опубликовать новый релиз каталога после загрузки меню'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Сколько запросов каждого этапа загрузки меню выполнять параллельно'
+    )
     parser.add_argument(
         '--addresses',
         type=str,
@@ -129,6 +147,155 @@ def make_slug(prod_name: str) -> str:
     return slug
 
 
+def make_import_item(product: dict) -> dict:
+    product_meta = {
+        "type": "product",
+        "attributes": {
+            "name": product['name'],
+            "slug": make_slug(product['name']),
+            "sku": md5(product['name'].encode('utf-8')).hexdigest()+'test12354',
+            "manage_stock": False,
+            "description": product['description'],
+            "status": "live",
+            "commodity_type": "physical"
+        }
+    }
+    price_meta = {
+        "data": {
+            "type": "product-price",
+            "attributes": {
+                "sku": product_meta['attributes']['sku'],
+                "currencies": {
+                    "RUB": {
+                        "amount": product['price'],
+                        "includes_tax": True
+                    }
+                }
+            }
+        }
+    }
+    return {
+        'name': product['name'],
+        'product_meta': product_meta,
+        'price_meta': price_meta,
+        'image_url': product['product_image']['url'],
+    }
+
+
+def describe_http_error(error: requests.exceptions.RequestException) -> str:
+    if error.response is None:
+        return str(error)
+    try:
+        return json.dumps(error.response.json(), ensure_ascii=False)
+    except ValueError:
+        return error.response.text
+
+
+class MenuImporter:
+    # Each of the five Moltin calls per product is a stage with its own
+    # thread pool and queue. A product goes to the next stage once its
+    # previous call has succeeded, so the calls of one product keep their
+    # order while different products overlap. max_in_flight bounds the
+    # products inside the pipeline, Motlin's rate limit bounds the calls.
+
+    def __init__(self,
+                 motlin_api: Motlin,
+                 pricebook_id: str,
+                 hierarchy_id: str,
+                 node_id: str,
+                 workers: int = 4,
+                 max_in_flight: int = None,
+                 progress: tqdm = None) -> MenuImporter:
+        self.motlin_api = motlin_api
+        self.pricebook_id = pricebook_id
+        self.hierarchy_id = hierarchy_id
+        self.node_id = node_id
+        self.progress = progress
+        self.stages = (
+            ('create_product', self._create_product),
+            ('create_product_price', self._create_product_price),
+            ('create_product_node_relationship', self._create_product_node_relationship),
+            ('add_file', self._add_file),
+            ('link_prod_and_image', self._link_prod_and_image),
+        )
+        self.executors = [
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'import-{name}')
+            for name, _ in self.stages
+        ]
+        self.in_flight = threading.Semaphore(max_in_flight or workers * len(self.stages))
+        self.lock = threading.Lock()
+        self.statuses = Counter()
+        self.calls = 0
+        self.failures = list()
+        self.started_at = time.monotonic()
+
+    def _create_product(self, item: dict) -> None:
+        response = self.motlin_api.create_product(product_data=item['product_meta'])
+        item['product_id'] = response['data']['id']
+
+    def _create_product_price(self, item: dict) -> None:
+        self.motlin_api.create_product_price(pricebook_id=self.pricebook_id, price_meta=item['price_meta'])
+
+    def _create_product_node_relationship(self, item: dict) -> None:
+        self.motlin_api.create_product_node_relationship(
+            hierarchy_id=self.hierarchy_id,
+            node_id=self.node_id,
+            products_ids=[item['product_id']]
+        )
+
+    def _add_file(self, item: dict) -> None:
+        item['image_id'] = self.motlin_api.add_file(image_url=item['image_url'])['data']['id']
+
+    def _link_prod_and_image(self, item: dict) -> None:
+        self.motlin_api.link_prod_and_image(product_id=item['product_id'], image_id=item['image_id'])
+
+    def _run_stage(self, stage_number: int, item: dict) -> None:
+        stage_name, stage = self.stages[stage_number]
+        try:
+            stage(item)
+        except requests.exceptions.HTTPError as error:
+            if stage_name == 'create_product' and SKU_EXISTS_ERROR_DETAIL in describe_http_error(error):
+                self._finish(item, 'skipped')
+            else:
+                self._finish(item, 'failed', stage_name, describe_http_error(error))
+            return
+        except Exception as error:
+            # a lost product would never free its place in the pipeline
+            self._finish(item, 'failed', stage_name, repr(error))
+            return
+        with self.lock:
+            self.calls += 1
+        if stage_number + 1 < len(self.stages):
+            self.executors[stage_number + 1].submit(self._run_stage, stage_number + 1, item)
+        else:
+            self._finish(item, 'imported')
+
+    def _finish(self, item: dict, status: str, stage_name: str = None, error: str = None) -> None:
+        with self.lock:
+            self.statuses[status] += 1
+            if error:
+                self.failures.append({'product': item['name'], 'stage': stage_name, 'error': error})
+            if self.progress is not None:
+                self.progress.set_postfix(
+                    calls_per_s=f'{self.calls / (time.monotonic() - self.started_at):.1f}',
+                    skipped=self.statuses['skipped'],
+                    failed=self.statuses['failed'],
+                    refresh=False
+                )
+                self.progress.update(1)
+        self.in_flight.release()
+
+    def run(self, menu: list) -> Counter:
+        self.started_at = time.monotonic()
+        for product in menu:
+            self.in_flight.acquire()
+            self.executors[0].submit(self._run_stage, 0, make_import_item(product))
+        # a stage only feeds the next one, so its pool is drained before the next is closed
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        return self.statuses
+
+
 def get_file_content(filepath: str) -> dict:
     try:
         with open(filepath, 'r') as fileout:
@@ -154,7 +321,14 @@ if __name__ == '__main__':
     
     motlin_api = Motlin(
         env.str('CLIENT_ID'),
-        env.str('CLIENT_SECRET')
+        env.str('CLIENT_SECRET'),
+        env.str('CATALOG_ID', None),
+        env.str('NODE_ID', None),
+        env.str('PRICEBOOK_ID', None),
+        env.str('PIZZERIAS_FLOW_ID', None),
+        rate_limit=env.float('MOTLIN_RATE_LIMIT', 20),
+        # every stage of the menu import keeps its own connections busy
+        pool_maxsize=max(16, 5 * args.workers),
     )
     
     menu_filepath = args.menu
@@ -212,61 +386,23 @@ if __name__ == '__main__':
 
         
         
-        for product in tqdm(menu, desc='add products'):
-            product_meta = {
-                "type": "product",
-                "attributes": {
-                    "name": product['name'],
-                    "slug": make_slug(product['name']),
-                    "sku": md5(product['name'].encode('utf-8')).hexdigest()+'test12354',
-                    "manage_stock": False,
-                    "description": product['description'],
-                    "status": "live",
-                    "commodity_type": "physical"
-                }
-            }
-            price_meta = {
-                "data": {
-                    "type": "product-price",
-                    "attributes": {
-                        "sku": product_meta['attributes']['sku'],
-                        "currencies": {
-                            "RUB": {
-                                "amount": product['price'],
-                                "includes_tax": True
-                            }
-                        }
-                    }
-                }
-            }
-            try:
-                new_product_response = motlin_api.create_product(product_data=product_meta)
-                motlin_api.create_product_price(pricebook_id=pricebook_id, price_meta=price_meta)
-                new_product_id = new_product_response['data']['id']
-                motlin_api.create_product_node_relationship(
-                    hierarchy_id=hierarchy_id,
-                    node_id=node_id,
-                    products_ids=[new_product_id]
-                )
-            except requests.exceptions.HTTPError as error:
-                if 'sku must be unique amongst products' in error.response.json()['errors'][0]['detail']:
-                    continue
-                
-                elif error.response.status_code:
-                    input(json.dumps(error.response.json(), indent=4))
-                    continue
-                else:
-                    sys.stdout.write(json.dumps(error.response.json(), indent=4))
-                    sys.exit(os.EX_IOERR)
-            
-            try:
-                image_url = product['product_image']['url']
-                image_response = motlin_api.add_file(image_url=image_url)
-                image_id = image_response['data']['id']
-                motlin_api.link_prod_and_image(product_id=new_product_id, image_id=image_id)
-            except requests.exceptions.HTTPError as error:
-                sys.stdout.write(json.dumps(error.response.json(), indent=4))
-                sys.exit(os.EX_IOERR)
+        with tqdm(total=len(menu), desc='add products') as progress:
+            importer = MenuImporter(
+                motlin_api,
+                pricebook_id,
+                hierarchy_id,
+                node_id,
+                workers=args.workers,
+                progress=progress
+            )
+            importer.run(menu)
+        if importer.failures:
+            sys.stdout.write(json.dumps(importer.failures, indent=4, ensure_ascii=False) + '\n')
+            sys.stdout.write(f'{len(importer.failures)} products failed, the catalog is not published\n')
+            sys.exit(os.EX_IOERR)
+
+        if args.publish:
+            motlin_api.publish_catalog(catalog_id=catalog_id)
 
     if addresses_filepath:
         addresses = get_file_content(filepath=addresses_filepath)
@@ -306,16 +442,20 @@ if __name__ == '__main__':
         current_entities = motlin_api.get_entries(flow_slug=flow_slug)
         current_addresses = [address['alias'] for address in current_entities]
         
-        for address in tqdm(addresses, desc='adding addresses'):
-            if address['alias'] in current_addresses:
-                continue
-            motlin_api.create_entry(
-                flow_slug=flow_slug,
-                address=address['address']['full'],
-                alias=address['alias'],
-                longitude=float(address['coordinates']['lon']),
-                latitude=float(address['coordinates']['lat'])
-            )
+        try:
+            for address in tqdm(addresses, desc='adding addresses'):
+                if address['alias'] in current_addresses:
+                    continue
+                motlin_api.create_entry(
+                    flow_slug=flow_slug,
+                    address=address['address']['full'],
+                    alias=address['alias'],
+                    longitude=float(address['coordinates']['lon']),
+                    latitude=float(address['coordinates']['lat'])
+                )
+        finally:
+            # entries added before a failure are live already
+            motlin_api.invalidate_pizzerias(flow_id=flow_id)
 
     if args.new_field_name:
         new_field_name = args.new_field_name
@@ -342,14 +482,18 @@ if __name__ == '__main__':
             pass
         flow_meta = motlin_api.get_flow(flow_id=os.getenv('PIZZERIAS_FLOW_ID'))
         entries = motlin_api.get_entries(flow_slug=flow_meta['data']['slug'])
-        for entry in tqdm(entries, desc='adding field value'):
-            try:
-                motlin_api.update_entry(
-                    flow_slug=flow_meta['data']['slug'],
-                    entry_id=entry['id'],
-                    field_slug=new_field_slug,
-                    field_value=default_value
-                )
-            except requests.exceptions.HTTPError as error:
-                sys.stdout.write(json.dumps(error.response.json(), indent=4))
-                sys.exit(os.EX_IOERR)
\ No newline at end of file
+        try:
+            for entry in tqdm(entries, desc='adding field value'):
+                try:
+                    motlin_api.update_entry(
+                        flow_slug=flow_meta['data']['slug'],
+                        entry_id=entry['id'],
+                        field_slug=new_field_slug,
+                        field_value=default_value
+                    )
+                except requests.exceptions.HTTPError as error:
+                    sys.stdout.write(json.dumps(error.response.json(), indent=4))
+                    sys.exit(os.EX_IOERR)
+        finally:
+            # a partial backfill has changed entries too
+            motlin_api.invalidate_pizzerias(flow_id=flow_meta['data']['id'])
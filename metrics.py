@@ -0,0 +1,179 @@
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def cumulative_counts(self) -> list:
+        counts, total = list(), 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            counts.append(total)
+        return counts
+
+
+class Metrics:
+    # Labelled counters, gauges and histograms of one component
+    # with Prometheus text and JSON exports.
+
+    def __init__(self, namespace: str) -> Metrics:
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.gauges = defaultdict(dict)
+        self.histograms = defaultdict(dict)
+
+    @staticmethod
+    def _labels_key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, labels: dict, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name][self._labels_key(labels)] += value
+
+    def set_gauge(self, name: str, labels: dict, value: float) -> None:
+        with self.lock:
+            self.gauges[name][self._labels_key(labels)] = value
+
+    def observe(self,
+                name: str,
+                labels: dict,
+                value: float,
+                buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> None:
+        labels_key = self._labels_key(labels)
+        with self.lock:
+            histogram = self.histograms[name].get(labels_key)
+            if histogram is None:
+                histogram = self.histograms[name][labels_key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'namespace': self.namespace,
+                'timestamp': time.time(),
+                'counters': {
+                    name: [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                'gauges': {
+                    name: [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+                    for name, series in self.gauges.items()
+                },
+                'histograms': {
+                    name: [
+                        {
+                            'labels': dict(labels),
+                            'buckets': dict(zip(map(str, histogram.buckets), histogram.cumulative_counts())),
+                            'count': histogram.count,
+                            'sum': histogram.sum,
+                        }
+                        for labels, histogram in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ''
+        escaped = (
+            f'{name}="{escape_label_value(value)}"'
+            for name, value in labels
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def to_prometheus(self) -> str:
+        lines = list()
+        with self.lock:
+            for name, series in self.counters.items():
+                metric_name = f'{self.namespace}_{name}'
+                lines.append(f'# TYPE {metric_name} counter')
+                for labels, value in series.items():
+                    lines.append(f'{metric_name}{self._format_labels(labels)} {value}')
+            for name, series in self.gauges.items():
+                metric_name = f'{self.namespace}_{name}'
+                lines.append(f'# TYPE {metric_name} gauge')
+                for labels, value in series.items():
+                    lines.append(f'{metric_name}{self._format_labels(labels)} {value}')
+            for name, series in self.histograms.items():
+                metric_name = f'{self.namespace}_{name}'
+                lines.append(f'# TYPE {metric_name} histogram')
+                for labels, histogram in series.items():
+                    for upper_bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                        bucket_labels = self._format_labels(labels, (('le', upper_bound),))
+                        lines.append(f'{metric_name}_bucket{bucket_labels} {count}')
+                    inf_labels = self._format_labels(labels, (('le', '+Inf'),))
+                    lines.append(f'{metric_name}_bucket{inf_labels} {histogram.count}')
+                    lines.append(f'{metric_name}_sum{self._format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{metric_name}_count{self._format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, filepath: str) -> None:
+        # write + rename, so readers never see a half written file
+        tmp_filepath = f'{filepath}.tmp'
+        with open(tmp_filepath, 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file)
+        os.replace(tmp_filepath, filepath)
+
+    def start_json_dump(self, filepath: str, interval: float = 60) -> threading.Event:
+        stop_event = threading.Event()
+
+        def dump_periodically():
+            while not stop_event.wait(interval):
+                self.dump_json(filepath)
+
+        threading.Thread(target=dump_periodically, name=f'{self.namespace}-metrics-dump', daemon=True).start()
+        return stop_event
+
+
+def start_prometheus_exporter(port: int, *metrics: Metrics, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = ''.join(component.to_prometheus() for component in metrics).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='prometheus-exporter', daemon=True).start()
+    return server
@@ -1,20 +1,195 @@
 from __future__ import annotations
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+from functools import wraps
+from typing import Iterator
+import json
+import logging
 import os
+import random
+import threading
+import time
 
 import requests
+from email.utils import parsedate_to_datetime
+from geopy.distance import geodesic
 from redis import Redis
-from datetime import datetime
+from redis.exceptions import LockError, RedisError
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
+
+from metrics import Metrics
+from session_store import SessionStore, UserSession
+
+API_URL = 'https://api.moltin.com'
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+TOO_MANY_REQUESTS = 429
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # Thread safe token bucket shared by every call of one client.
+
+    def __init__(self, rate: float, capacity: float = None) -> TokenBucket:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        # takes a token in advance and returns how long to wait for it
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        # after 429 nobody should call the API for a while
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def parse_retry_after(retry_after: str | None) -> float | None:
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_delay(attempt: int,
+                    retry_after: float = None,
+                    base_delay: float = 0.5,
+                    max_delay: float = 30) -> float:
+    if retry_after is not None:
+        return min(retry_after, max_delay)
+    # exponential backoff with jitter
+    return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def is_retryable_status(status_code: int, idempotent: bool) -> bool:
+    # 429 means Moltin refused the request, so it is safe to repeat any method
+    return status_code in RETRY_STATUS_CODES and (idempotent or status_code == TOO_MANY_REQUESTS)
+
+
+def is_retryable_error(idempotent: bool, connect_failed: bool) -> bool:
+    # a request that could not connect never reached Moltin
+    return idempotent or connect_failed
+
+
+class TokenRenewer(threading.Thread):
+    # Refreshes the shared token ahead of expiry, so request handling
+    # threads only read the token and never call /oauth/access_token.
+
+    def __init__(self,
+                 motlin_api: Motlin,
+                 renew_ahead: int = 600,
+                 jitter: int = 30,
+                 retry_base_delay: float = 1,
+                 retry_max_delay: float = 60) -> TokenRenewer:
+        super().__init__(name='motlin-token-renewer', daemon=True)
+        self.motlin_api = motlin_api
+        self.renew_ahead = renew_ahead
+        self.jitter = jitter
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.last_success = None
+        self.last_error = None
+        self.consecutive_failures = 0
+        self._stop_event = threading.Event()
+
+    @property
+    def is_healthy(self) -> bool:
+        return self.is_alive() and not self.motlin_api._is_token_expired()
+
+    def health(self) -> dict:
+        return {
+            'healthy': self.is_healthy,
+            'token_expired': self.motlin_api.token_expired,
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'consecutive_failures': self.consecutive_failures,
+        }
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _next_delay(self) -> float:
+        if self.consecutive_failures:
+            # exponential backoff with full jitter
+            backoff = self.retry_base_delay * 2 ** (self.consecutive_failures - 1)
+            return random.uniform(0, min(backoff, self.retry_max_delay))
+        renew_at = self.motlin_api.token_expired - self.renew_ahead
+        # jitter spreads renewals of several processes over time
+        return max(0, renew_at - datetime.now().timestamp()) + random.uniform(0, self.jitter)
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._next_delay()):
+            try:
+                self.motlin_api._renew_token(spare_time=self.renew_ahead)
+            except Exception as error:
+                # the thread must outlive any failure, nobody else renews the token
+                self.consecutive_failures += 1
+                self.last_error = f'{datetime.now().isoformat()} {error!r}'
+                logger.warning('Token renewal failed (%s in a row): %r', self.consecutive_failures, error)
+            else:
+                self.consecutive_failures = 0
+                self.last_success = datetime.now().isoformat()
 
 
 class Motlin:
     EXPIRED_SPARE_TIME = 300  # seconds
+    TOKEN_LOCK_TIMEOUT = 30  # seconds
+    MAX_RETRIES = 3
+    PAGE_LIMIT = 100
+    MAX_PAGE_WORKERS = 4
+    DEFAULT_TIMEOUT = (3.05, 10)  # seconds, (connect, read)
+    ENDPOINT_TIMEOUTS = {
+        'get_token': (3.05, 5),
+        'add_file': (3.05, 30),
+        'get_entries': (3.05, 20),
+        'get_pricebook': (3.05, 30),
+        'get_products': (3.05, 20),
+        'fetch_products_in_release': (3.05, 20),
+        'publish_catalog': (3.05, 30),
+    }
+    CATALOG_CACHE_TTL = 60 * 60  # seconds, releases published outside of publish_catalog
+    PRICE_INDEX_REBUILD_INTERVAL = 60  # seconds, limits rebuilds caused by unknown sku
+    PRICE_INDEX_TTL = 24 * 60 * 60  # seconds, an expired index is rebuilt on the next lookup
+    LATEST_RELEASE_TTL = 30 * 24 * 60 * 60  # seconds, without the pointer 'latest' is read
+    PHOTO_FILE_ID_TTL = 30 * 24 * 60 * 60  # seconds, photo is uploaded again after that
+    PIZZERIAS_CACHE_TTL = 24 * 60 * 60  # seconds
+    # extra candidates of the redis (haversine) search, re-ranked by geodesic distance
+    NEAREST_PIZZERIAS_SPARE = 3
+    EARTH_HALF_CIRCUMFERENCE_KM = 20038
     
     client_id = str()
     client_secret = str()
 
     token = str()
-    token_expired = str()
+    token_expired = 0
 
     catalog_id = None
     node_id = None
@@ -33,7 +208,18 @@ class Motlin:
                  redis_host: str = 'localhost',
                  redis_port: int = 6379,
                  redis_password: str = None,
-                 redis_db: int = 0) -> Motlin:
+                 redis_db: int = 0,
+                 api_url: str = API_URL,
+                 pool_connections: int = 4,
+                 pool_maxsize: int = 16,
+                 pool_block: bool = False,
+                 keep_alive: bool = True,
+                 token_renewal: bool = False,
+                 rate_limit: float = 20,
+                 rate_burst: float = None,
+                 max_retries: int = MAX_RETRIES,
+                 metrics: Metrics = None,
+                 session_ttl: int = SessionStore.SESSION_TTL) -> Motlin:
 
         self.redis = Redis(
             host=redis_host,
@@ -42,37 +228,251 @@ class Motlin:
             db=redis_db,
             decode_responses=True
         )
+        self.sessions = SessionStore(self.redis, ttl=session_ttl)
+        self.api_url = api_url.rstrip('/')
+        self.session = self._make_session(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            keep_alive=keep_alive
+        )
+        # requests per second, None turns throttling off
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst) if rate_limit else None
+        self.max_retries = max_retries
+        # None keeps the request path free of any bookkeeping
+        self.metrics = metrics
+        self.current_endpoint = threading.local()
         self.client_id = client_id
         self.client_secret = client_secret
-        self.token, self.token_expired = self.get_token(
-            client_id=client_id,
-            client_secret=client_secret
-        )
+        self.token_key = f'motlin:{client_id}:token'
+        self.token_lock_key = f'motlin:{client_id}:token_lock'
+        self._sync_token()
+        self.token_renewer = None
+        self.release_cache = dict()
+        # handlers of different chats run in parallel threads
+        self.release_cache_lock = threading.Lock()
+        self.price_index = dict()
+        if token_renewal:
+            self.start_token_renewal()
         self.catalog_id = catalog_id
         self.node_id = node_id
         self.pricebook_id = pricebook_id
         self.flow_id = flow_id
 
+    @staticmethod
+    def _make_session(pool_connections: int,
+                      pool_maxsize: int,
+                      pool_block: bool,
+                      keep_alive: bool) -> requests.Session:
+        # pool_connections - how many hosts keep their own pool,
+        # pool_maxsize - how many connections are kept alive per host,
+        # pool_block - wait for a free connection instead of opening an extra one.
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        return session
+
+    def close(self) -> None:
+        self.stop_token_renewal()
+        self.session.close()
+
+    def start_token_renewal(self, **renewer_kwargs) -> TokenRenewer:
+        if not (self.token_renewer and self.token_renewer.is_alive()):
+            self.token_renewer = TokenRenewer(self, **renewer_kwargs)
+            self.token_renewer.start()
+        return self.token_renewer
+
+    def stop_token_renewal(self) -> None:
+        if self.token_renewer:
+            self.token_renewer.stop()
+            self.token_renewer = None
+
+    def _set_token(self, token: str, token_expired: int) -> None:
+        self.token, self.token_expired = token, token_expired
+        self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def _request(self,
+                 method: str,
+                 url: str,
+                 endpoint: str = None,
+                 idempotent: bool = None,
+                 **kwargs) -> requests.Response:
+        # Every Moltin call goes through here: throttling, timeouts and retries.
+        # Non idempotent calls are retried only when Moltin surely did not
+        # process them (429 or failed connect).
+        endpoint = endpoint or getattr(self.current_endpoint, 'name', None)
+        if endpoint is None:
+            # untagged calls would be reported as one endpoint="None" series
+            raise ValueError(f'No endpoint name for {method} {url}')
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.ENDPOINT_TIMEOUTS.get(endpoint, self.DEFAULT_TIMEOUT))
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            started_at = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if self.metrics:
+                    self._observe_request(endpoint, method, type(error).__name__, started_at)
+                connect_failed = isinstance(error, requests.exceptions.ConnectTimeout)
+                if not is_retryable_error(idempotent, connect_failed) or attempt >= self.max_retries:
+                    raise
+                delay = get_retry_delay(attempt)
+            else:
+                if self.metrics:
+                    self._observe_request(endpoint, method, response.status_code, started_at, response)
+                if not is_retryable_status(response.status_code, idempotent) or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = get_retry_delay(attempt, retry_after)
+                if response.status_code == TOO_MANY_REQUESTS and self.rate_limiter:
+                    self.rate_limiter.pause(delay)
+            logger.info('Retrying %s %s in %.2fs (attempt %s)', endpoint, method, delay, attempt + 1)
+            if self.metrics:
+                self.metrics.inc('retries_total', {'endpoint': endpoint})
+            attempt += 1
+            time.sleep(delay)
+
+    def _observe_request(self,
+                         endpoint: str,
+                         method: str,
+                         status: int | str,
+                         started_at: float,
+                         response: requests.Response = None) -> None:
+        labels = {'endpoint': endpoint, 'method': method}
+        self.metrics.observe('request_duration_seconds', labels, time.perf_counter() - started_at)
+        self.metrics.inc('responses_total', {**labels, 'status': status})
+        if response is None:
+            return
+        request_body = response.request.body or b''
+        self.metrics.inc('request_bytes_total', labels, len(request_body))
+        self.metrics.inc('response_bytes_total', labels, len(response.content))
+
     def get_token(self,
                   client_id: str = client_id,
                   client_secret: str = client_secret) -> tuple[str]:
-        access_token_url = 'https://api.moltin.com/oauth/access_token'
+        access_token_url = f'{self.api_url}/oauth/access_token'
         access_token_data = {
-            'client_id': client_id,
-            'client_secret': client_secret,
+            'client_id': client_id or self.client_id,
+            'client_secret': client_secret or self.client_secret,
             'grant_type': 'client_credentials',
         }
-        response = requests.get(access_token_url, data=access_token_data)
-        response.raise_for_status()
+        # None drops the session-wide bearer header for this call only
+        response = self._request(
+            'GET',
+            access_token_url,
+            endpoint='get_token',
+            data=access_token_data,
+            headers={'Authorization': None}
+        )
         token_meta = response.json()
         return token_meta['access_token'], int(token_meta['expires'])
 
+    def _is_token_expiring(self, spare_time: int = EXPIRED_SPARE_TIME) -> bool:
+        return datetime.now().timestamp() + spare_time > self.token_expired
+
+    def _is_token_expired(self) -> bool:
+        return datetime.now().timestamp() >= self.token_expired
+
+    def _load_shared_token(self) -> bool:
+        token_meta = self.redis.hgetall(self.token_key)
+        if not token_meta:
+            return False
+        self._set_token(token_meta['token'], int(token_meta['expires']))
+        return True
+
+    def _store_shared_token(self, token: str, token_expired: int) -> None:
+        with self.redis.pipeline() as pipe:
+            pipe.hset(self.token_key, mapping={'token': token, 'expires': token_expired})
+            pipe.expireat(self.token_key, token_expired)
+            pipe.execute()
+        self._set_token(token, token_expired)
+
+    def _token_lock(self):
+        return self.redis.lock(
+            self.token_lock_key,
+            timeout=self.TOKEN_LOCK_TIMEOUT,
+            thread_local=False
+        )
+
+    def _refresh_shared_token(self, lock, spare_time: int = EXPIRED_SPARE_TIME) -> None:
+        try:
+            # token could be refreshed by other process while we waited for the lock
+            if self._load_shared_token() and not self._is_token_expiring(spare_time):
+                return
+            self._store_shared_token(*self.get_token())
+        finally:
+            with suppress(LockError):
+                lock.release()
+
+    def _refresh_shared_token_in_background(self, lock) -> None:
+        try:
+            self._refresh_shared_token(lock)
+        except (requests.exceptions.RequestException, RedisError) as error:
+            logger.warning('Token refresh failed: %r', error)
+
+    def _renew_token(self, spare_time: int = EXPIRED_SPARE_TIME) -> None:
+        if self._load_shared_token() and not self._is_token_expiring(spare_time):
+            return
+        lock = self._token_lock()
+        if lock.acquire(blocking_timeout=self.TOKEN_LOCK_TIMEOUT):
+            self._refresh_shared_token(lock, spare_time=spare_time)
+        else:
+            raise LockError('Token lock is held by another process for too long')
+
+    def _sync_token(self) -> None:
+        # Token is shared by every bot worker and load_db.py run through redis.
+        # Only the lock holder calls /oauth/access_token, the others keep
+        # using the still valid token and pick up the new one from redis.
+        if self._load_shared_token() and not self._is_token_expiring():
+            return
+        if self._is_token_expired():
+            # there is no valid token at all - nothing to do but wait for it
+            self._renew_token()
+            return
+        lock = self._token_lock()
+        if lock.acquire(blocking=False):
+            threading.Thread(
+                target=self._refresh_shared_token_in_background,
+                args=(lock,),
+                daemon=True
+            ).start()
+
+    def _ensure_token(self) -> None:
+        if not self._is_token_expiring():
+            return
+        if self.token_renewer and self.token_renewer.is_alive():
+            # renewer keeps redis up to date, just pick the token up
+            self._load_shared_token()
+            return
+        try:
+            self._sync_token()
+        except (requests.exceptions.RequestException, LockError) as error:
+            logger.warning('Token refresh failed: %r', error)
+
     def _refresh_token_if_expired(func, **kwargs):
+        endpoint = func.__name__.lstrip('_')
+
+        @wraps(func)
         def wrapper(self, **kwargs):
-            if datetime.now().timestamp() + self.EXPIRED_SPARE_TIME > self.token_expired:
-                with suppress(requests.exceptions.HTTPError):
-                    self.token, self.token_expired = self.get_token()
-            return func(self, **kwargs)
+            self._ensure_token()
+            # endpoint name tags requests made by the call, nested calls restore it
+            outer_endpoint = getattr(self.current_endpoint, 'name', None)
+            self.current_endpoint.name = endpoint
+            try:
+                return func(self, **kwargs)
+            finally:
+                self.current_endpoint.name = outer_endpoint
         return wrapper
 
     @_refresh_token_if_expired
@@ -81,10 +481,7 @@ class Motlin:
                        description: str,
                        hierarchy_ids: list[str],
                        pricebook_id: str) -> dict:
-        url = 'https://api.moltin.com/pcm/catalogs'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/catalogs'
         request_data = {
             "data": {
                 "type": "catalog",
@@ -96,41 +493,34 @@ class Motlin:
                 }
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
     
     @_refresh_token_if_expired
     def publish_catalog(self, catalog_id: str) -> dict:
-        url = f'https://api.moltin.com/pcm/catalogs/{catalog_id}/releases'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}/releases'
         request_data = {
             "data": {
                 "export_full_delta": True
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
-        return response.json()
+        response = self._request('POST', url, json=request_data)
+        release = response.json()
+        stale_keys = list(self.redis.scan_iter(self.release_keys_pattern(catalog_id)))
+        with self.redis.pipeline() as pipe:
+            self.queue_release_switch(pipe, catalog_id, release['data']['id'], stale_keys)
+            pipe.execute()
+        return release
     
     @_refresh_token_if_expired
     def get_catalog(self, catalog_id: str) -> dict:
-        url = f'https://api.moltin.com/pcm/catalogs/{catalog_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}'
+        response = self._request('GET', url)
         return response.json()
 
     @_refresh_token_if_expired
     def create_hierarchy(self, hierarchy_name: str) -> dict:
-        url = 'https://api.moltin.com/pcm/hierarchies/'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/hierarchies/'
         request_data = {
             "data": {
                 "type": "hierarchy",
@@ -139,16 +529,12 @@ class Motlin:
                 }
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
 
     @_refresh_token_if_expired
     def create_node(self, hierarchy_id: str, node_name:str) -> dict:
-        url = f'https://api.moltin.com/pcm/hierarchies/{hierarchy_id}/nodes'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/hierarchies/{hierarchy_id}/nodes'
         request_data = {
             "data": {
                 "type": "node",
@@ -157,32 +543,22 @@ class Motlin:
                 }
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
 
     @_refresh_token_if_expired
     def get_product(self, product_id: str) -> dict:
-        url = f'https://api.moltin.com/pcm/products/{product_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/products/{product_id}'
         params = {
             "include": "main_image",
         }
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        response = self._request('GET', url, params=params)
         return response.json()
 
     @_refresh_token_if_expired
     def create_product(self, product_data: dict) -> str:
-        url = 'https://api.moltin.com/pcm/products'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        response = requests.post(url, headers=headers, json={"data": product_data})
-        response.raise_for_status()
+        url = f'{self.api_url}/pcm/products'
+        response = self._request('POST', url, json={"data": product_data})
         return response.json()
 
     @_refresh_token_if_expired
@@ -190,10 +566,7 @@ class Motlin:
                                         hierarchy_id: str,
                                         node_id: str,
                                         products_ids: list|tuple) -> dict:
-        url = f'https://api.moltin.com/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/relationships/products'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/hierarchies/{hierarchy_id}/nodes/{node_id}/relationships/products'
         request_data = {
             "data": [
                 {
@@ -203,47 +576,169 @@ class Motlin:
                 for product_id in products_ids
             ]
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
 
     @_refresh_token_if_expired
     def add_file(self, image_url: str) -> dict:
-        url = 'https://api.moltin.com/v2/files'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/v2/files'
         files = {
             "file_location": (None, image_url)
         }
-        response = requests.post(url, headers=headers, files=files)
-        response.raise_for_status()
+        response = self._request('POST', url, files=files)
         return response.json()
 
     @_refresh_token_if_expired
     def link_prod_and_image(self, product_id: str, image_id: str) -> None:
-        url = f'https://api.moltin.com/pcm/products/{product_id}/relationships/main_image'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
+        url = f'{self.api_url}/pcm/products/{product_id}/relationships/main_image'
         request_data = {
             "data": {
                 "type": "file",
                 "id": image_id
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        self._request('POST', url, json=request_data)
+        self.invalidate_photo_file_id(product_id=product_id)
+
+    @staticmethod
+    def _photo_file_id_key(product_id: str) -> str:
+        return f'motlin:product:{product_id}:telegram_photo'
+
+    def get_photo_file_id(self, product_id: str, image_id: str) -> str | None:
+        # Telegram file_id of the product main image, sent once already.
+        # Stored together with the image id, so a new image is never answered with the old photo.
+        photo = self.redis.hgetall(self._photo_file_id_key(product_id))
+        if photo.get('image_id') == image_id:
+            return photo.get('file_id')
+
+    def set_photo_file_id(self, product_id: str, image_id: str, file_id: str) -> None:
+        photo_key = self._photo_file_id_key(product_id)
+        with self.redis.pipeline() as pipe:
+            pipe.hset(photo_key, mapping={'image_id': image_id, 'file_id': file_id})
+            pipe.expire(photo_key, self.PHOTO_FILE_ID_TTL)
+            pipe.execute()
+
+    def invalidate_photo_file_id(self, product_id: str) -> None:
+        with self.redis.pipeline() as pipe:
+            self.queue_photo_invalidation(pipe, product_id)
+            pipe.execute()
+
+    @classmethod
+    def queue_photo_invalidation(cls, pipe, product_id: str) -> None:
+        # shared with AsyncMotlin
+        pipe.delete(cls._photo_file_id_key(product_id))
 
     @_refresh_token_if_expired
-    def get_flow(self, flow_id: str = flow_id) -> dict:
-        url = f'https://api.moltin.com/v2/flows/{flow_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+    def get_flow(self, flow_id: str = None) -> dict:
+        url = f'{self.api_url}/v2/flows/{flow_id or self.flow_id}'
+        response = self._request('GET', url)
         return response.json()
+
+    @staticmethod
+    def _pizzerias_key(flow_id: str) -> str:
+        return f'motlin:flow:{flow_id}:pizzerias'
+
+    def get_pizzerias(self, flow_id: str = None) -> dict:
+        # Pizzerias registry: flow slug and all of its entries, cached in redis.
+        # Call invalidate_pizzerias after changing the flow entries.
+        flow_id = flow_id or self.flow_id
+        cached_pizzerias = self.redis.get(self._pizzerias_key(flow_id))
+        if cached_pizzerias:
+            return json.loads(cached_pizzerias)
+        flow_slug = self.get_flow(flow_id=flow_id)['data']['slug']
+        pizzerias = {
+            'slug': flow_slug,
+            'entries': self.get_entries(flow_slug=flow_slug, concurrent=True),
+        }
+        self.redis.set(
+            self._pizzerias_key(flow_id),
+            json.dumps(pizzerias),
+            ex=self.PIZZERIAS_CACHE_TTL
+        )
+        self._index_pizzerias(flow_id, pizzerias['entries'])
+        return pizzerias
+
+    def _index_pizzerias(self, flow_id: str, entries: list) -> None:
+        # redis GEO set of the pizzerias plus entry by id, for nearest and radius queries
+        geo_key = f'{self._pizzerias_key(flow_id)}:geo'
+        entries_key = f'{self._pizzerias_key(flow_id)}:entries'
+        points = list()
+        for entry in entries:
+            try:
+                points.extend((float(entry['longitude']), float(entry['latitude']), entry['id']))
+            except (KeyError, TypeError, ValueError):
+                logger.warning('Pizzeria %s has no valid coordinates', entry.get('id'))
+        with self.redis.pipeline() as pipe:
+            pipe.delete(geo_key, entries_key)
+            if points:
+                pipe.geoadd(geo_key, points)
+                pipe.hset(entries_key, mapping={entry['id']: json.dumps(entry) for entry in entries})
+                pipe.expire(geo_key, self.PIZZERIAS_CACHE_TTL)
+                pipe.expire(entries_key, self.PIZZERIAS_CACHE_TTL)
+            pipe.execute()
+
+    def find_nearest_pizzerias(self,
+                               longitude: float,
+                               latitude: float,
+                               count: int = 1,
+                               radius_km: float = None,
+                               flow_id: str = None) -> list[dict]:
+        # Pizzerias sorted by distance, each with 'distance' in km added.
+        flow_id = flow_id or self.flow_id
+        geo_key = f'{self._pizzerias_key(flow_id)}:geo'
+
+        def search():
+            return self.redis.geosearch(
+                geo_key,
+                longitude=longitude,
+                latitude=latitude,
+                radius=radius_km or self.EARTH_HALF_CIRCUMFERENCE_KM,
+                unit='km',
+                sort='ASC',
+                count=count + self.NEAREST_PIZZERIAS_SPARE,
+                withdist=True
+            )
+
+        candidates = search()
+        if not candidates and not self.redis.exists(geo_key):
+            self._index_pizzerias(flow_id, self.get_pizzerias(flow_id=flow_id)['entries'])
+            candidates = search()
+        if not candidates:
+            return list()
+
+        pizzerias = list()
+        entries = self.redis.hmget(
+            f'{self._pizzerias_key(flow_id)}:entries',
+            [entry_id for entry_id, _ in candidates]
+        )
+        for entry in filter(None, entries):
+            pizzeria = json.loads(entry)
+            pizzeria['distance'] = geodesic(
+                (latitude, longitude),
+                (float(pizzeria['latitude']), float(pizzeria['longitude']))
+            ).km
+            if radius_km is None or pizzeria['distance'] <= radius_km:
+                pizzerias.append(pizzeria)
+        return sorted(pizzerias, key=lambda pizzeria: pizzeria['distance'])[:count]
+
+    def get_pizzeria(self, entry_id: str, flow_id: str = None) -> dict | None:
+        for pizzeria in self.get_pizzerias(flow_id=flow_id)['entries']:
+            if pizzeria['id'] == entry_id:
+                return pizzeria
+
+    def invalidate_pizzerias(self, flow_id: str = None) -> None:
+        pizzerias_key = self._pizzerias_key(flow_id or self.flow_id)
+        # :zones is the delivery zones map of delivery_zones.py, a new :generation
+        # makes a zones build started before this call discard its result
+        with self.redis.pipeline() as pipe:
+            pipe.delete(
+                pizzerias_key,
+                f'{pizzerias_key}:geo',
+                f'{pizzerias_key}:entries',
+                f'{pizzerias_key}:zones'
+            )
+            pipe.set(f'{pizzerias_key}:generation', time.time_ns(), ex=self.PIZZERIAS_CACHE_TTL)
+            pipe.execute()
         
     @_refresh_token_if_expired
     def create_flow(self,
@@ -251,10 +746,7 @@ class Motlin:
                     description: str,
                     slug: str,
                     enabled: bool = True):
-        url = 'https://api.moltin.com/v2/flows'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
+        url = f'{self.api_url}/v2/flows'
         request_data = {
             "data": {
                 "type": "flow",
@@ -264,18 +756,13 @@ class Motlin:
                 "enabled": enabled
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
     
     @_refresh_token_if_expired
     def get_flow_fields(self, flow_slug: str) -> set:
-        url = f'https://api.moltin.com/v2/flows/{flow_slug}/fields'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        url = f'{self.api_url}/v2/flows/{flow_slug}/fields'
+        response = self._request('GET', url)
         return response.json()
     
     @_refresh_token_if_expired
@@ -287,10 +774,7 @@ class Motlin:
                      flow_id: str,
                      required: bool = True,
                      enabled: bool = True):
-        url = 'https://api.moltin.com/v2/fields'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
+        url = f'{self.api_url}/v2/fields'
         request_data = {
             "data": {
                 "type": "field",
@@ -310,40 +794,70 @@ class Motlin:
                 }
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
 
+    def _iter_pages(self,
+                    url: str,
+                    endpoint: str,
+                    params: dict = None,
+                    concurrent: bool = False,
+                    page_limit: int = PAGE_LIMIT,
+                    max_workers: int = MAX_PAGE_WORKERS) -> Iterator[dict]:
+        # Yields pages of a list endpoint as they arrive.
+        # concurrent=True fetches the rest of the pages in parallel once the
+        # first page tells the total; at most max_workers pages are held at once.
+        params = {**(params or {}), 'page[limit]': page_limit, 'page[offset]': 0}
+        self._ensure_token()
+        page = self._request('GET', url, endpoint=endpoint, params=params).json()
+        yield page
+        total = page.get('meta', {}).get('results', {}).get('total')
+        if not concurrent or total is None:
+            while page['data'] and page.get('links', {}).get('next'):
+                self._ensure_token()
+                page = self._request('GET', page['links']['next'], endpoint=endpoint).json()
+                yield page
+            return
+
+        pending_pages = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for offset in range(page_limit, total, page_limit):
+                    self._ensure_token()
+                    pending_pages.append(executor.submit(
+                        self._request,
+                        'GET',
+                        url,
+                        endpoint=endpoint,
+                        params={**params, 'page[offset]': offset}
+                    ))
+                    if len(pending_pages) >= max_workers:
+                        yield pending_pages.popleft().result().json()
+                while pending_pages:
+                    yield pending_pages.popleft().result().json()
+            finally:
+                # consumer stopped early - do not download the rest
+                for pending_page in pending_pages:
+                    pending_page.cancel()
+
+    def iter_entries(self, flow_slug: str, concurrent: bool = False) -> Iterator[dict]:
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries'
+        for page in self._iter_pages(url, endpoint='get_entries', concurrent=concurrent):
+            yield from page['data']
+
     @_refresh_token_if_expired
     def get_entries(self,
-                     flow_slug: str) -> list:
-        url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        entries = list()
-        while True:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            entries_meta = response.json()
-            entries += entries_meta['data']
-            if not entries_meta['data'] or not entries_meta['links']['next']:
-                break
-            else:
-                url = entries_meta['links']['next']
-        return entries
+                     flow_slug: str,
+                     concurrent: bool = False) -> list:
+        return list(self.iter_entries(flow_slug=flow_slug, concurrent=concurrent))
     
 
     @_refresh_token_if_expired
     def get_entry(self,
                      flow_slug: str,
                      entry_id: str) -> dict:
-        url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries/{entry_id}'
+        response = self._request('GET', url)
         return response.json()
     
 
@@ -354,10 +868,7 @@ class Motlin:
                      alias: str,
                      longitude: float,
                      latitude: float) -> dict:
-        url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries'
         request_data = {
             "data": {
                 "type": "entry",
@@ -367,8 +878,7 @@ class Motlin:
                 "latitude": latitude
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
     
     @_refresh_token_if_expired
@@ -377,10 +887,7 @@ class Motlin:
                      entry_id: str,
                      field_slug: str,
                      field_value: str):
-        url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/v2/flows/{flow_slug}/entries/{entry_id}'
         request_data = {
             "data": {
                 "type": "entry",
@@ -388,51 +895,128 @@ class Motlin:
                 field_slug: field_value,
             }
         }
-        response = requests.put(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('PUT', url, json=request_data)
         return response.json()
 
 
+    def iter_products(self, concurrent: bool = False) -> Iterator[dict]:
+        url = f'{self.api_url}/pcm/products'
+        for page in self._iter_pages(url, endpoint='get_products', concurrent=concurrent):
+            yield from page['data']
+
     @_refresh_token_if_expired
-    def get_products(self):
-        url = 'https://api.moltin.com/pcm/products'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    def get_products(self, concurrent: bool = False) -> dict:
+        return {'data': list(self.iter_products(concurrent=concurrent))}
     
+    @staticmethod
+    def _latest_release_key(catalog_id: str) -> str:
+        return f'motlin:catalog:{catalog_id}:latest_release'
+
+    @staticmethod
+    def _release_products_key(catalog_id: str, release_id: str, node_id: str) -> str:
+        return f'motlin:catalog:{catalog_id}:release:{release_id}:node:{node_id}:products'
+
+    @staticmethod
+    def release_keys_pattern(catalog_id: str) -> str:
+        return f'motlin:catalog:{catalog_id}:release:*'
+
+    @classmethod
+    def queue_release_switch(cls, pipe, catalog_id: str, release_id: str, stale_keys: list) -> None:
+        # every process switches to the new release on its next menu render,
+        # shared with AsyncMotlin
+        pipe.set(cls._latest_release_key(catalog_id), release_id, ex=cls.LATEST_RELEASE_TTL)
+        if stale_keys:
+            pipe.delete(*stale_keys)
+
+    def get_latest_release_id(self, catalog_id: str = None) -> str:
+        # 'latest' until the first publish_catalog call records a real release id
+        return self.redis.get(self._latest_release_key(catalog_id or self.catalog_id)) or 'latest'
+
+    def iter_products_in_release(self,
+                                 catalog_id: str = None,
+                                 node_id: str = None,
+                                 release_id: str = 'latest',
+                                 concurrent: bool = False) -> Iterator[dict]:
+        # uncached, get_products_in_release is the cached variant
+        catalog_id = catalog_id or self.catalog_id
+        node_id = node_id or self.node_id
+        url = f'{self.api_url}/pcm/catalogs/{catalog_id}/releases/{release_id}/nodes/{node_id}/relationships/products'
+        for page in self._iter_pages(url, endpoint='fetch_products_in_release', concurrent=concurrent):
+            yield from page['data']
+
     @_refresh_token_if_expired
+    def _fetch_products_in_release(self,
+                                   catalog_id: str,
+                                   node_id: str,
+                                   release_id: str) -> dict:
+        return {
+            'data': list(self.iter_products_in_release(
+                catalog_id=catalog_id,
+                node_id=node_id,
+                release_id=release_id,
+                concurrent=True
+            ))
+        }
+
     def get_products_in_release(self,
-                                catalog_id: str = catalog_id,
-                                node_id: str = node_id,
+                                catalog_id: str = None,
+                                node_id: str = None,
                                 release_id: str = 'latest') -> dict:
-        url = f'https://api.moltin.com/pcm/catalogs/{catalog_id}/releases/{release_id}/nodes/{node_id}/relationships/products'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.json()
+        # Read-through cache: process memory -> redis -> Moltin.
+        # Releases never change, so a release id is a complete cache version.
+        # 'release_id' of the result is the release the products come from.
+        catalog_id = catalog_id or self.catalog_id
+        node_id = node_id or self.node_id
+        if release_id == 'latest':
+            release_id = self.get_latest_release_id(catalog_id)
+        cache_key = (catalog_id, release_id, node_id)
+        with self.release_cache_lock:
+            cached_until, products = self.release_cache.get(cache_key, (0, None))
+        if datetime.now().timestamp() < cached_until:
+            return products
+
+        products_key = self._release_products_key(catalog_id, release_id, node_id)
+        cached_products = self.redis.get(products_key)
+        if cached_products:
+            products = json.loads(cached_products)
+            products.setdefault('release_id', release_id)
+        else:
+            try:
+                products = self._fetch_products_in_release(
+                    catalog_id=catalog_id,
+                    node_id=node_id,
+                    release_id=release_id
+                )
+            except requests.exceptions.HTTPError as error:
+                if release_id == 'latest' or error.response.status_code != 404:
+                    raise
+                # just published release is not available yet, not cached
+                products = self._fetch_products_in_release(
+                    catalog_id=catalog_id,
+                    node_id=node_id,
+                    release_id='latest'
+                )
+                products['release_id'] = 'latest'
+                return products
+            products['release_id'] = release_id
+            self.redis.set(products_key, json.dumps(products), ex=self.CATALOG_CACHE_TTL)
+
+        with self.release_cache_lock:
+            for stale_key in [key for key in self.release_cache if key[0] == catalog_id and key[2] == node_id]:
+                del self.release_cache[stale_key]
+            self.release_cache[cache_key] = (datetime.now().timestamp() + self.CATALOG_CACHE_TTL, products)
+        return products
 
     @_refresh_token_if_expired
-    def get_pricebook(self, pricebook_id: str = pricebook_id, include_prices: bool = True) -> dict:
-        url = f'https://api.moltin.com/pcm/pricebooks/{pricebook_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+    def get_pricebook(self, pricebook_id: str = None, include_prices: bool = True) -> dict:
+        url = f'{self.api_url}/pcm/pricebooks/{pricebook_id or self.pricebook_id}'
         params = {"include": "prices"} if include_prices else {}
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        response = self._request('GET', url, params=params)
         return response.json()
     
     @_refresh_token_if_expired
     def create_pricebook(self, pricebook_name: str, pricebook_description: str = '') -> dict:
-        url = 'https://api.moltin.com/pcm/pricebooks'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+        url = f'{self.api_url}/pcm/pricebooks'
         request_data = {
             "data": {
                 "type": "pricebook",
@@ -442,75 +1026,135 @@ class Motlin:
                 }
             }
         }
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=request_data)
         return response.json()
     
     @_refresh_token_if_expired
     def create_product_price(self, pricebook_id: str, price_meta: dict) -> dict:
-        url = f'https://api.moltin.com/pcm/pricebooks/{pricebook_id}/prices'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.post(url, headers=headers, json=price_meta)
-        response.raise_for_status()
-        return response.json()
+        url = f'{self.api_url}/pcm/pricebooks/{pricebook_id}/prices'
+        response = self._request('POST', url, json=price_meta)
+        price = response.json()
+        version_key, _ = self._price_index_keys(pricebook_id)
+        if self.redis.exists(version_key):
+            with self.redis.pipeline() as pipe:
+                self.queue_price_patch(pipe, pricebook_id, price)
+                pipe.execute()
+        return price
+
+    @classmethod
+    def queue_price_patch(cls, pipe, pricebook_id: str, price: dict) -> None:
+        # patch the existing index instead of rebuilding it, shared with AsyncMotlin
+        version_key, prices_key = cls._price_index_keys(pricebook_id)
+        pipe.hset(
+            prices_key,
+            price['data']['attributes']['sku'],
+            json.dumps(price['data']['attributes']['currencies'])
+        )
+        pipe.expire(prices_key, cls.PRICE_INDEX_TTL)
+        pipe.incr(version_key)
+        pipe.expire(version_key, cls.PRICE_INDEX_TTL)
+
+    @staticmethod
+    def _price_index_keys(pricebook_id: str) -> tuple[str]:
+        return (
+            f'motlin:pricebook:{pricebook_id}:version',
+            f'motlin:pricebook:{pricebook_id}:prices',
+        )
+
+    def _build_price_index(self, pricebook_id: str) -> str:
+        version_key, prices_key = self._price_index_keys(pricebook_id)
+        with self.redis.lock(f'motlin:pricebook:{pricebook_id}:build_lock', timeout=60):
+            version = self.redis.get(version_key)
+            built_at = self.redis.get(f'{prices_key}:built_at')
+            if version and datetime.now().timestamp() - float(built_at or 0) < self.PRICE_INDEX_REBUILD_INTERVAL:
+                # somebody has just built it
+                return version
+            pricebook = self.get_pricebook(pricebook_id=pricebook_id, include_prices=True)
+            prices = {
+                price['attributes']['sku']: json.dumps(price['attributes']['currencies'])
+                for price in pricebook.get('included', [])
+            }
+            # the old version may have expired, a counter would start over and
+            # could match a version some process still keeps in memory
+            version = str(time.time_ns())
+            with self.redis.pipeline() as pipe:
+                pipe.delete(prices_key)
+                if prices:
+                    pipe.hset(prices_key, mapping=prices)
+                    pipe.expire(prices_key, self.PRICE_INDEX_TTL)
+                pipe.set(f'{prices_key}:built_at', datetime.now().timestamp(), ex=self.PRICE_INDEX_TTL)
+                # version goes last and expires together with the index
+                pipe.set(version_key, version, ex=self.PRICE_INDEX_TTL)
+                pipe.execute()
+        return version
+
+    def get_product_price(self, sku: str, pricebook_id: str = None) -> dict | None:
+        # SKU -> currencies index, kept in redis and process memory.
+        # Memory copy is reloaded from redis only when the index version changes.
+        pricebook_id = pricebook_id or self.pricebook_id
+        version_key, prices_key = self._price_index_keys(pricebook_id)
+        version = self.redis.get(version_key) or self._build_price_index(pricebook_id)
+        cached_version, prices = self.price_index.get(pricebook_id, (None, None))
+        if cached_version != version:
+            prices = {
+                price_sku: json.loads(currencies)
+                for price_sku, currencies in self.redis.hgetall(prices_key).items()
+            }
+            self.price_index[pricebook_id] = (version, prices)
+        if sku not in prices:
+            built_at = float(self.redis.get(f'{prices_key}:built_at') or 0)
+            if datetime.now().timestamp() - built_at > self.PRICE_INDEX_REBUILD_INTERVAL:
+                # price could be added outside of create_product_price
+                self._build_price_index(pricebook_id)
+                return self.get_product_price(sku=sku, pricebook_id=pricebook_id)
+        return prices.get(sku)
     
     @_refresh_token_if_expired
     def create_cart(self,
                     name: str = f'{int(datetime.now().timestamp())}_cart') -> dict:
-        url = 'https://api.moltin.com/v2/carts'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            'Content-Type': 'application/json',
-        }
+        url = f'{self.api_url}/v2/carts'
         post_data = {
             "data": {
                 "name": name,
             }
         }
-        response = requests.post(url, headers=headers, json=post_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=post_data)
         return response.json()
 
     def _create_or_refresh_cart(func, **kwargs):
+        @wraps(func)
         def wrapper(self, **kwargs):
-            user_telegram_id = kwargs.get('user_telegram_id')
-            cart_id = self.redis.get(f'{user_telegram_id}_cart_id')
-            cart_expired = self.redis.get(f'{user_telegram_id}_cart_expired')
-            if not (cart_id and cart_expired) or \
+            # the wrapped method gets the loaded session, so the cart id is read once
+            session = kwargs.get('session')
+            if session is None:
+                session = self.sessions.load(kwargs.get('user_telegram_id'))
+            cart_expired = session.get('cart_expired')
+            if not (session.get('cart_id') and cart_expired) or \
                 datetime.now().timestamp() + self.EXPIRED_SPARE_TIME > int(cart_expired):
                 new_cart = self.create_cart()
 
                 expired_at = new_cart['data']['meta']['timestamps']['expires_at']
                 datetime_obj = datetime.fromisoformat(expired_at + '+03:00')
 
-                self.redis.set(f'{user_telegram_id}_cart_id', new_cart['data']['id'])
-                self.redis.set(f'{user_telegram_id}_cart_expired', int(datetime_obj.timestamp()))
+                session.set(cart_id=new_cart['data']['id'], cart_expired=int(datetime_obj.timestamp()))
+                self.sessions.save(session)
+            kwargs['session'] = session
             return func(self, **kwargs)
         return wrapper
 
     @_refresh_token_if_expired
     def delete_cart(self, cart_id: str) -> None:
-        url = f'https://api.moltin.com/v2/carts/{cart_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
-        response = requests.delete(url, headers=headers)
-        response.raise_for_status()
+        url = f'{self.api_url}/v2/carts/{cart_id}'
+        self._request('DELETE', url)
 
     @_refresh_token_if_expired
     @_create_or_refresh_cart
     def add_product_to_cart(self,
                             user_telegram_id: int,
                             product_id: str,
-                            quantity: int):
-        cart_id = self.redis.get(f'{user_telegram_id}_cart_id')
-        url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            'Content-Type': 'application/json',
-        }
+                            quantity: int,
+                            session: UserSession = None):
+        url = f'{self.api_url}/v2/carts/{session["cart_id"]}/items'
         post_data = {
             "data": {
                 "id": product_id,
@@ -518,38 +1162,29 @@ class Motlin:
                 'quantity': quantity
             }
         }
-        response = requests.post(url, headers=headers, json=post_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=post_data)
         return response.json()
     
     @_refresh_token_if_expired
     @_create_or_refresh_cart
     def get_cart(self,
-                 user_telegram_id: int) -> dict:
-        cart_id = self.redis.get(f'{user_telegram_id}_cart_id')
-        url = f'https://api.moltin.com/v2/carts/{cart_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
+                 user_telegram_id: int,
+                 session: UserSession = None) -> dict:
+        url = f'{self.api_url}/v2/carts/{session["cart_id"]}'
         params = {
             "include": "items",
         }
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        response = self._request('GET', url, params=params)
         return response.json()
     
     @_refresh_token_if_expired
     @_create_or_refresh_cart
     def remove_product_from_cart(self,
                                  user_telegram_id: int,
-                                 item_id: str) -> dict:
-        cart_id = self.redis.get(f'{user_telegram_id}_cart_id')
-        url = f'https://api.moltin.com/v2/carts/{cart_id}/items/{item_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-        response = requests.delete(url, headers=headers)
-        response.raise_for_status()
+                                 item_id: str,
+                                 session: UserSession = None) -> dict:
+        url = f'{self.api_url}/v2/carts/{session["cart_id"]}/items/{item_id}'
+        response = self._request('DELETE', url)
         return response.json()
     
     @_refresh_token_if_expired
@@ -557,10 +1192,7 @@ class Motlin:
                         name: str,
                         email: str,
                         user_telegram_id: int) -> dict:
-        url = 'https://api.moltin.com/v2/customers'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
+        url = f'{self.api_url}/v2/customers'
         post_data = {
             "data": {
                 "type": "customer",
@@ -568,10 +1200,9 @@ class Motlin:
                 "email": email,
             }
         }
-        response = requests.post(url, headers=headers, json=post_data)
-        response.raise_for_status()
+        response = self._request('POST', url, json=post_data)
         response_meta = response.json()
-        self.redis.set(f'{user_telegram_id}_customer_id', response_meta['data']['id'])
+        self.sessions.update(user_telegram_id, customer_id=response_meta['data']['id'])
         return response_meta
     
     @_refresh_token_if_expired
@@ -579,10 +1210,7 @@ class Motlin:
                                 customer_id: str,
                                 longitude: float,
                                 latitude: float) -> dict:
-        url = f'https://api.moltin.com/v2/customers/{customer_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
+        url = f'{self.api_url}/v2/customers/{customer_id}'
         put_data = {
             "data": {
                 "type": "customer",
@@ -590,16 +1218,11 @@ class Motlin:
                 "latitude": latitude
             }
         }
-        response = requests.put(url, headers=headers, json=put_data)
-        response.raise_for_status()
+        response = self._request('PUT', url, json=put_data)
         return response.json()
     
     @_refresh_token_if_expired
     def get_customer(self, customer_id: str) -> dict:
-        url = f'https://api.moltin.com/v2/customers/{customer_id}'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        url = f'{self.api_url}/v2/customers/{customer_id}'
+        response = self._request('GET', url)
         return response.json()
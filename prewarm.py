@@ -0,0 +1,119 @@
+import argparse
+import logging
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from environs import Env
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+from motlin import Motlin
+
+APP_DESCRIPTION = 'Uploads photos of the whole catalog to Telegram before the first customer asks for them'
+
+IMAGE_TIMEOUT = (3.05, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def send_respecting_flood_control(send, **kwargs):
+    while True:
+        try:
+            return send(**kwargs)
+        except RetryAfter as error:
+            time.sleep(error.retry_after)
+
+
+def prewarm_product(motlin_api: Motlin,
+                    bot: Bot,
+                    chat_id: int,
+                    product_id: str,
+                    image_session: requests.Session) -> str:
+    product = motlin_api.get_product(product_id=product_id)
+    motlin_api.get_product_price(sku=product['data']['attributes']['sku'])
+
+    main_images = product.get('included', {}).get('main_images')
+    if not main_images:
+        return 'no image'
+    main_image = main_images[0]
+    if motlin_api.get_photo_file_id(product_id=product_id, image_id=main_image['id']):
+        return 'cached'
+
+    image_response = image_session.get(main_image['link']['href'], timeout=IMAGE_TIMEOUT)
+    image_response.raise_for_status()
+    message = send_respecting_flood_control(
+        bot.send_photo,
+        chat_id=chat_id,
+        photo=image_response.content,
+        disable_notification=True
+    )
+    motlin_api.set_photo_file_id(
+        product_id=product_id,
+        image_id=main_image['id'],
+        file_id=message.photo[-1].file_id
+    )
+    try:
+        # the file id outlives the message, the service chat stays clean
+        bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+    except TelegramError:
+        pass
+    return 'uploaded'
+
+
+def prewarm_catalog(motlin_api: Motlin, bot: Bot, chat_id: int, max_workers: int = 4) -> Counter:
+    products = motlin_api.get_products_in_release()['data']
+    statuses = Counter()
+    with requests.Session() as image_session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(prewarm_product, motlin_api, bot, chat_id, product['id'], image_session): product['id']
+            for product in products
+        }
+        for future in as_completed(futures):
+            try:
+                statuses[future.result()] += 1
+            except (requests.exceptions.RequestException, TelegramError, KeyError):
+                logger.exception('Prewarm of product %s failed', futures[future])
+                statuses['failed'] += 1
+    logger.info('Catalog prewarm finished: %s', dict(statuses))
+    return statuses
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    parser.add_argument(
+        '--chat_id',
+        type=int,
+        help='Служебный чат для загрузки фотографий, по умолчанию PREWARM_CHAT_ID из .env'
+    )
+    parser.add_argument('--workers', type=int, default=4)
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    env = Env()
+    env.read_env()
+
+    args = create_parser().parse_args()
+    chat_id = args.chat_id or env.int('PREWARM_CHAT_ID')
+
+    motlin_api = Motlin(
+        env.str('CLIENT_ID'),
+        env.str('CLIENT_SECRET'),
+        env.str('CATALOG_ID'),
+        env.str('NODE_ID'),
+        env.str('PRICEBOOK_ID'),
+        env.str('PIZZERIAS_FLOW_ID'),
+        rate_limit=env.float('MOTLIN_RATE_LIMIT', 20),
+    )
+    bot = Bot(
+        token=env.str('TELEGRAM_BOT_TOKEN'),
+        request=Request(con_pool_size=args.workers + 1)
+    )
+    print(dict(prewarm_catalog(motlin_api, bot, chat_id, max_workers=args.workers)))
+    motlin_api.close()
@@ -0,0 +1,249 @@
+from __future__ import annotations
+import json
+import logging
+import threading
+import time
+
+from collections import defaultdict
+from collections.abc import MutableMapping
+from typing import Callable
+from uuid import uuid4
+
+from redis import Redis
+from telegram.ext import BasePersistence, CallbackContext, Job, JobQueue
+
+from session_store import SessionStore
+
+SCHEDULED_JOBS_KEY = 'bot:scheduled_jobs'
+CHAT_DATA_FIELD = 'chat_data'
+
+logger = logging.getLogger(__name__)
+
+
+def chat_state_key(chat_id: int | str) -> str:
+    # conversation states and chat_data of one chat, a small listpack hash
+    return f'chat:{chat_id}:state'
+
+
+class RedisConversations(MutableMapping):
+    # The conversations dict of a ConversationHandler, read through to redis,
+    # so every replica sees the state another one has written.
+
+    def __init__(self, persistence: RedisPersistence, name: str) -> RedisConversations:
+        self.persistence = persistence
+        self.name = name
+
+    def __getitem__(self, key: tuple):
+        state = self.persistence.get_conversation_state(self.name, key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key: tuple, state) -> None:
+        self.persistence.update_conversation(self.name, key, state)
+
+    def __delitem__(self, key: tuple) -> None:
+        self.persistence.update_conversation(self.name, key, None)
+
+    def __iter__(self):
+        # a full scan, ConversationHandler itself never iterates
+        self.persistence.flush()
+        for redis_key in self.persistence.redis.scan_iter(chat_state_key('*'), count=1000):
+            chat_id = int(redis_key.split(':')[1])
+            for field in self.persistence.redis.hkeys(redis_key):
+                name, _, rest = field.partition(':')
+                if name == self.name:
+                    yield (chat_id, *(int(part) for part in rest.split(':'))) if rest else (chat_id, chat_id)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class RedisPersistence(BasePersistence):
+    # Conversation states and chat_data in one hash per chat, which expires
+    # with the user's session. Writes are buffered and sent in one pipeline
+    # every flush_interval, reads see the buffer first. A crash loses at
+    # most flush_interval of state changes.
+    FLUSH_INTERVAL = 0.5
+    MAX_PENDING_CHATS = 500
+
+    def __init__(self,
+                 redis: Redis,
+                 ttl: int = SessionStore.SESSION_TTL,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 store_chat_data: bool = True) -> RedisPersistence:
+        super().__init__(store_user_data=False, store_chat_data=store_chat_data, store_bot_data=False)
+        self.redis = redis
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # chat id -> {field: value, None to delete}
+        self.pending = dict()
+        # the batch being written, still read from memory until redis has it
+        self.flushing = dict()
+        self.flush_lock = threading.Lock()
+        # chat_data last written per chat, unchanged chat_data is not rewritten
+        self.written_chat_data = dict()
+        # states that are not strings (run_async promises) never leave the process
+        self.local_states = dict()
+        self.flush_requested = threading.Event()
+        threading.Thread(target=self._flush_periodically, name='persistence-flush', daemon=True).start()
+
+    @staticmethod
+    def _conversation_field(name: str, key: tuple) -> str:
+        # key is (chat_id, user_id), the chat id goes to the redis key
+        # and a private chat, where both are the same, keeps the name only
+        rest = key[1:] if key[1:] != key[:1] else ()
+        return ':'.join((name, *(str(part) for part in rest)))
+
+    def _write(self, chat_id: int, field: str, value: str | None) -> None:
+        with self.lock:
+            self.pending.setdefault(chat_id, dict())[field] = value
+            if len(self.pending) >= self.MAX_PENDING_CHATS:
+                self.flush_requested.set()
+
+    def _read(self, chat_id: int, field: str) -> str | None:
+        with self.lock:
+            for batch in (self.pending, self.flushing):
+                if field in batch.get(chat_id, {}):
+                    return batch[chat_id][field]
+        return self.redis.hget(chat_state_key(chat_id), field)
+
+    def get_conversations(self, name: str) -> RedisConversations:
+        return RedisConversations(self, name)
+
+    def get_conversation_state(self, name: str, key: tuple):
+        with self.lock:
+            if (name, key) in self.local_states:
+                return self.local_states[(name, key)]
+        return self._read(key[0], self._conversation_field(name, key))
+
+    def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        if new_state is not None and not isinstance(new_state, str):
+            with self.lock:
+                self.local_states[(name, key)] = new_state
+            return
+        with self.lock:
+            self.local_states.pop((name, key), None)
+        self._write(key[0], self._conversation_field(name, key), new_state)
+
+    def get_chat_data(self) -> defaultdict:
+        # filled per chat by refresh_chat_data
+        return defaultdict(dict)
+
+    def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        encoded_chat_data = self._read(chat_id, CHAT_DATA_FIELD)
+        chat_data.clear()
+        if encoded_chat_data:
+            chat_data.update(json.loads(encoded_chat_data))
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        try:
+            encoded_chat_data = json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None
+        except TypeError:
+            logger.exception('chat_data of chat %s is not JSON serializable', chat_id)
+            return
+        with self.lock:
+            if self.written_chat_data.get(chat_id) == encoded_chat_data:
+                return
+            if encoded_chat_data is None:
+                self.written_chat_data.pop(chat_id, None)
+            else:
+                self.written_chat_data[chat_id] = encoded_chat_data
+        self._write(chat_id, CHAT_DATA_FIELD, encoded_chat_data)
+
+    def get_user_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return dict()
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                pending = self.flushing = self.pending
+                self.pending = dict()
+            try:
+                if pending:
+                    self._write_batch(pending)
+            finally:
+                with self.lock:
+                    self.flushing = dict()
+
+    def _write_batch(self, pending: dict) -> None:
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for chat_id, fields in pending.items():
+                    key = chat_state_key(chat_id)
+                    changed_fields = {field: value for field, value in fields.items() if value is not None}
+                    deleted_fields = [field for field, value in fields.items() if value is None]
+                    if changed_fields:
+                        pipe.hset(key, mapping=changed_fields)
+                    if deleted_fields:
+                        pipe.hdel(key, *deleted_fields)
+                    pipe.expire(key, self.ttl)
+                pipe.execute()
+        except Exception:
+            # back into the buffer under the writes made since, the next flush retries
+            with self.lock:
+                for chat_id, fields in pending.items():
+                    self.pending[chat_id] = {**fields, **self.pending.get(chat_id, {})}
+            raise
+
+    def _flush_periodically(self) -> None:
+        while True:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Persistence flush failed')
+
+    def run_once(self, job_queue: JobQueue, callback: Callable, when: float, context: str = None) -> Job:
+        # The job is kept in a zset until it has run, so it survives a restart.
+        # Its name is the zset member, see claim_job.
+        member = json.dumps([uuid4().hex, callback.__name__, context], ensure_ascii=False)
+        self.redis.zadd(SCHEDULED_JOBS_KEY, {member: time.time() + when})
+        return job_queue.run_once(callback, when, context=context, name=member)
+
+    def claim_job(self, job: Job) -> bool:
+        # Every replica restores the same jobs, the one that removes it runs it
+        return bool(self.redis.zrem(SCHEDULED_JOBS_KEY, job.name))
+
+    def restore_jobs(self, job_queue: JobQueue, callbacks: dict) -> int:
+        # callbacks: function name -> function, jobs of unknown callbacks stay in the zset
+        now = time.time()
+        restored = 0
+        for member, run_at in self.redis.zrange(SCHEDULED_JOBS_KEY, 0, -1, withscores=True):
+            _, callback_name, context = json.loads(member)
+            if callback_name not in callbacks:
+                continue
+            job_queue.run_once(callbacks[callback_name], max(run_at - now, 0), context=context, name=member)
+            restored += 1
+        return restored
+
+
+def run_once(job_queue: JobQueue,
+             context: CallbackContext,
+             callback: Callable,
+             when: float,
+             job_context: str = None) -> Job:
+    # job_queue.run_once, kept in redis when the dispatcher has RedisPersistence
+    persistence = context.dispatcher.persistence
+    if isinstance(persistence, RedisPersistence):
+        return persistence.run_once(job_queue, callback, when, job_context)
+    return job_queue.run_once(callback, when, context=job_context)
+
+
+def claim_job(context: CallbackContext) -> bool:
+    # False when another replica has run the job already
+    persistence = context.dispatcher.persistence
+    if isinstance(persistence, RedisPersistence):
+        return persistence.claim_job(context.job)
+    return True
@@ -0,0 +1,213 @@
+from __future__ import annotations
+import argparse
+import sys
+import time
+
+from environs import Env
+from redis import Redis
+
+APP_DESCRIPTION = 'Per-user session state of the telegram bot'
+
+SESSION_FIELDS = (
+    'cart_id',
+    'cart_expired',
+    'customer_id',
+    'coordinates',
+    'nearest_pizzeria_id',
+    'nearest_pizzeria_admin_id',
+    'is_delivery',
+)
+
+# session field -> key the bot used before the session hash
+LEGACY_USER_KEYS = {
+    'cart_id': '{user_id}_cart_id',
+    'cart_expired': '{user_id}_cart_expired',
+    'customer_id': '{user_id}_customer_id',
+    'coordinates': '{user_id}_cordinates',
+    'nearest_pizzeria_id': '{user_id}_nearest_pizzeria_id',
+}
+LEGACY_ADMIN_KEY = 'pizerria_{pizzeria_id}_admin_id'
+LEGACY_IS_DELIVERY_KEY = '{cart_id}_is_delivery'
+
+CART_FIELDS = ('cart_id', 'cart_expired', 'is_delivery')
+
+
+def session_key(user_id: int | str) -> str:
+    return f'session:{user_id}'
+
+
+class UserSession(dict):
+    # Session fields of one user. Changes are collected by set()/delete()
+    # and written by SessionStore.save() in one round-trip.
+
+    def __init__(self, user_id: int | str, fields: dict) -> UserSession:
+        super().__init__(fields)
+        self.user_id = user_id
+        self.changed_fields = set()
+        self.deleted_fields = set()
+
+    def set(self, **fields) -> None:
+        for name, value in fields.items():
+            self[name] = value
+            self.changed_fields.add(name)
+            self.deleted_fields.discard(name)
+
+    def delete(self, *names: str) -> None:
+        for name in names:
+            self.pop(name, None)
+            self.changed_fields.discard(name)
+            self.deleted_fields.add(name)
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self.changed_fields or self.deleted_fields)
+
+
+def is_cart_expired(fields: dict, now: float = None) -> bool:
+    cart_expired = fields.get('cart_expired')
+    return bool(cart_expired) and int(cart_expired) <= (now or time.time())
+
+
+class SessionStore:
+    # Sessions live while the user is active: every load and save
+    # pushes the expiry of the hash forward by the inactivity ttl.
+    SESSION_TTL = 30 * 24 * 60 * 60
+    PRUNE_SCAN_COUNT = 500
+
+    def __init__(self, redis: Redis, ttl: int = SESSION_TTL) -> SessionStore:
+        self.redis = redis
+        self.ttl = ttl
+
+    def load(self, user_id: int | str) -> UserSession:
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(session_key(user_id))
+            pipe.expire(session_key(user_id), self.ttl)
+            fields, _ = pipe.execute()
+        if not fields:
+            fields = self._migrate_user(user_id)
+        session = UserSession(user_id, fields)
+        if is_cart_expired(session):
+            # Moltin has dropped the cart already, the next save cleans the fields up
+            session.delete(*CART_FIELDS)
+        return session
+
+    def save(self, session: UserSession) -> None:
+        if not session.is_dirty:
+            return
+        key = session_key(session.user_id)
+        with self.redis.pipeline(transaction=False) as pipe:
+            if session.changed_fields:
+                pipe.hset(key, mapping={name: session[name] for name in session.changed_fields})
+            if session.deleted_fields:
+                pipe.hdel(key, *session.deleted_fields)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        session.changed_fields.clear()
+        session.deleted_fields.clear()
+
+    def update(self, user_id: int | str, **fields) -> None:
+        # blind write, when the handler does not need to read the session
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(session_key(user_id), mapping=fields)
+            pipe.expire(session_key(user_id), self.ttl)
+            pipe.execute()
+
+    def prune(self) -> dict:
+        # Drops fields of carts that Moltin has expired and puts a ttl
+        # on sessions written before sessions had one.
+        pruned = {'sessions': 0, 'expired_carts': 0, 'ttl_set': 0}
+        now = time.time()
+        for key in self.redis.scan_iter('session:*', count=self.PRUNE_SCAN_COUNT):
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hget(key, 'cart_expired')
+                pipe.ttl(key)
+                cart_expired, ttl = pipe.execute()
+            pruned['sessions'] += 1
+            with self.redis.pipeline(transaction=False) as pipe:
+                if is_cart_expired({'cart_expired': cart_expired}, now):
+                    pipe.hdel(key, *CART_FIELDS)
+                    pruned['expired_carts'] += 1
+                if ttl == -1:
+                    pipe.expire(key, self.ttl)
+                    pruned['ttl_set'] += 1
+                pipe.execute()
+        return pruned
+
+    def _migrate_user(self, user_id: int | str) -> dict:
+        # lazy migration of users who have not been seen since the hash was introduced
+        legacy_keys = [key.format(user_id=user_id) for key in LEGACY_USER_KEYS.values()]
+        legacy_values = self.redis.mget(legacy_keys)
+        fields = {
+            name: value
+            for name, value in zip(LEGACY_USER_KEYS, legacy_values)
+            if value is not None
+        }
+        if not fields:
+            return fields
+        if fields.get('nearest_pizzeria_id'):
+            admin_id = self.redis.get(LEGACY_ADMIN_KEY.format(pizzeria_id=fields['nearest_pizzeria_id']))
+            if admin_id:
+                fields['nearest_pizzeria_admin_id'] = admin_id
+        if fields.get('cart_id'):
+            is_delivery = self.redis.get(LEGACY_IS_DELIVERY_KEY.format(cart_id=fields['cart_id']))
+            if is_delivery is not None:
+                fields['is_delivery'] = is_delivery
+        with self.redis.pipeline() as pipe:
+            pipe.hset(session_key(user_id), mapping=fields)
+            pipe.expire(session_key(user_id), self.ttl)
+            pipe.delete(*legacy_keys)
+            pipe.execute()
+        return fields
+
+
+def migrate_legacy_keys(redis: Redis) -> int:
+    # Moves all users at once. Admin ids and is_delivery flags are copied
+    # into the sessions while migrating users, so they are dropped last.
+    store = SessionStore(redis)
+    user_ids = {
+        key[:-len('_customer_id')] if key.endswith('_customer_id') else key[:-len('_cart_id')]
+        for pattern in ('*_customer_id', '*_cart_id')
+        for key in redis.scan_iter(pattern)
+        if not key.startswith('session:')
+    }
+    migrated_users = 0
+    for user_id in user_ids:
+        if not redis.exists(session_key(user_id)) and store._migrate_user(user_id):
+            migrated_users += 1
+    for pattern in ('pizerria_*_admin_id', '*_is_delivery'):
+        for key in redis.scan_iter(pattern):
+            redis.delete(key)
+    return migrated_users
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    parser.add_argument(
+        '--migrate',
+        action='store_true',
+        help='Перенести состояние пользователей из отдельных ключей в хеши session:{id}'
+    )
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='Удалить из сессий истекшие корзины и выставить ttl сессиям без него'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    env = Env()
+    env.read_env()
+
+    args = create_parser().parse_args()
+    if not (args.migrate or args.prune):
+        create_parser().print_help()
+        sys.exit()
+
+    # same redis as the bot, Motlin connects with the defaults too
+    redis = Redis(decode_responses=True)
+    if args.migrate:
+        sys.stdout.write(f'Migrated users: {migrate_legacy_keys(redis)}\n')
+    if args.prune:
+        store = SessionStore(redis, ttl=env.int('SESSION_TTL_DAYS', 30) * 24 * 60 * 60)
+        sys.stdout.write(f'Pruned: {store.prune()}\n')
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+import threading
+
+from queue import Full
+
+from environs import Env
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from chat_dispatcher import get_chat_key
+from webhook import start_dispatching, start_webhook_server
+
+APP_DESCRIPTION = 'Webhook front and bot worker processes sharded by chat id'
+
+# tells a shard worker to stop after the updates queued before it
+STOP = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_ring_hash(value: str) -> int:
+    # stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    # Consistent hashing: every shard owns many points on the ring, a chat
+    # belongs to the first point after its hash. Adding a shard moves only
+    # the chats of the points it takes over, about 1 / shards of them.
+    POINTS_PER_SHARD = 160
+
+    def __init__(self, shards: list, points_per_shard: int = POINTS_PER_SHARD) -> HashRing:
+        points = sorted(
+            (get_ring_hash(f'shard:{shard}:{point}'), shard)
+            for shard in shards
+            for point in range(points_per_shard)
+        )
+        self.hashes = [point_hash for point_hash, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def get_shard(self, chat_key) -> int:
+        index = bisect.bisect(self.hashes, get_ring_hash(str(chat_key)))
+        return self.shards[index % len(self.shards)]
+
+
+class ShardedUpdateQueue:
+    # Stands in for the update queue of the webhook server: puts every
+    # update into the queue of the shard that owns its chat. A full shard
+    # queue raises queue.Full, the webhook answers 503.
+
+    def __init__(self, shard_queues: list, ring: HashRing) -> ShardedUpdateQueue:
+        self.shard_queues = shard_queues
+        self.ring = ring
+
+    def put(self, update: Update, block: bool = True, timeout: float = None) -> None:
+        shard = self.ring.get_shard(get_chat_key(update))
+        self.shard_queues[shard].put(update.to_dict(), block, timeout)
+
+    def qsize(self) -> int:
+        try:
+            return sum(shard_queue.qsize() for shard_queue in self.shard_queues)
+        except NotImplementedError:
+            # macOS has no sem_getvalue
+            return 0
+
+
+def feed_dispatcher(shard_queue, dispatcher: Dispatcher) -> None:
+    # blocks while the dispatcher queue is full, so the shard queue fills up in turn
+    while True:
+        update_data = shard_queue.get()
+        if update_data is STOP:
+            return
+        dispatcher.update_queue.put(Update.de_json(update_data, dispatcher.bot))
+
+
+def run_shard(shard: int, shard_queue) -> None:
+    # Ctrl+C reaches the whole process group, shards stop when the front says so
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    # the bot module is heavy, the front process does not need it
+    from telegram_bot import create_bot, create_metrics
+
+    env = Env()
+    env.read_env()
+    updater = create_bot(
+        env,
+        create_metrics(env, shard=shard),
+        update_queue_size=env.int('SHARD_QUEUE_SIZE', 200),
+        run_maintenance=shard == 0
+    )
+    start_dispatching(updater)
+    logger.info('Shard %s started', shard)
+    feed_dispatcher(shard_queue, updater.dispatcher)
+    updater.stop()
+    if updater.persistence is not None:
+        updater.persistence.flush()
+
+
+def start_shard(context, shard: int, shard_queue):
+    process = context.Process(target=run_shard, args=(shard, shard_queue), name=f'bot-shard-{shard}')
+    process.start()
+    return process
+
+
+def run_sharded_bot(env: Env, shards: int) -> None:
+    # Shards are spawned, not forked, the front has threads running by then
+    context = multiprocessing.get_context('spawn')
+    shard_queues = [context.Queue(maxsize=env.int('SHARD_QUEUE_SIZE', 200)) for _ in range(shards)]
+    processes = [start_shard(context, shard, shard_queue) for shard, shard_queue in enumerate(shard_queues)]
+
+    bot = Bot(token=env.str('TELEGRAM_BOT_TOKEN'))
+    server = start_webhook_server(
+        ShardedUpdateQueue(shard_queues, HashRing(range(shards))),
+        bot,
+        env.int('WEBHOOK_PORT'),
+        env.str('WEBHOOK_SECRET'),
+        path=env.str('WEBHOOK_PATH', '/telegram')
+    )
+    if env.str('WEBHOOK_URL', None):
+        bot.set_webhook(
+            url=env.str('WEBHOOK_URL'),
+            secret_token=env.str('WEBHOOK_SECRET'),
+            max_connections=100
+        )
+
+    stop_requested = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop_requested.set())
+    logger.info('Webhook is listening on port %s, %s shards', env.int('WEBHOOK_PORT'), shards)
+    while not stop_requested.wait(1):
+        for shard, process in enumerate(processes):
+            if not process.is_alive():
+                # the chats of the shard wait in its queue meanwhile
+                logger.error('Shard %s exited with code %s, restarting', shard, process.exitcode)
+                processes[shard] = start_shard(context, shard, shard_queues[shard])
+
+    server.shutdown()
+    for shard_queue in shard_queues:
+        try:
+            shard_queue.put(STOP, timeout=10)
+        except Full:
+            logger.error('Shard queue is still full, the shard is stopped without its backlog')
+    for process in processes:
+        process.join(timeout=30)
+        if process.is_alive():
+            process.terminate()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Сколько процессов бота запустить, по умолчанию по числу ядер'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = create_parser().parse_args()
+    env = Env()
+    env.read_env()
+    run_sharded_bot(env, args.shards)
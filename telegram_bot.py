@@ -1,17 +1,21 @@
+from __future__ import annotations
 import json
 import os
 import re
+import threading
 
 from contextlib import suppress
+from datetime import datetime
 from environs import Env
 from functools import partial
+from queue import Queue
 from more_itertools import chunked
 from textwrap import dedent
 
 import requests
 
-from geopy import distance as geopy_distance
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -20,6 +24,7 @@ from telegram import (
 from telegram.error import BadRequest
 from telegram.ext import (
     Updater,
+    Dispatcher,
     CommandHandler,
     MessageHandler,
     CallbackContext,
@@ -29,12 +34,25 @@ from telegram.ext import (
     PreCheckoutQueryHandler
 )
 from telegram.ext.jobqueue import JobQueue
+from telegram.utils.request import Request
 
-from geo_processing import fetch_coordinates
+from async_motlin import AsyncMotlin
+from chat_dispatcher import ChatOrderedDispatcher
+from delivery_zones import DeliveryZones
+from geo_processing import Gazetteer, GeocoderCache
+from metrics import Metrics, start_prometheus_exporter
 from motlin import Motlin
+from prewarm import prewarm_catalog
+from redis_persistence import RedisPersistence, claim_job, run_once
+from session_store import UserSession
+from webhook import run_webhook
 
 PRODUCTS_PER_MESSAGE = 10
 
+# (catalog_id, release_id, node_id, page_size) -> (cached_until, pages)
+menu_pages_cache = dict()
+menu_pages_cache_lock = threading.Lock()
+
 ONE_HOUR = 60 * 60
 
 CUSTOMER_ALREADY_EXISTS_ERROR_CODE = 409
@@ -59,42 +77,86 @@ def delete_prev_message(func, *args, **kwargs):
     return wrapper
 
 
-def make_products_inline(motlin_api: Motlin,
-                         items_in_row: int = 2,
-                         left_border: int = 0,
-                         right_border: int = PRODUCTS_PER_MESSAGE) -> InlineKeyboardMarkup:
-    assert left_border >= 0
-    assert right_border >= 0
-    products = motlin_api.get_products_in_release()['data']
-    chunked_products = list(chunked(products[left_border:right_border], items_in_row))
-    if not chunked_products:
-        # perhaps DB was refactored / became shorter or something else.
-        # this is emergency option
-        chunked_products = list(chunked(products[:PRODUCTS_PER_MESSAGE], items_in_row))
-    buttons = [
-        [
-            InlineKeyboardButton(
-                text=product['attributes']['name'],
-                callback_data=f'product:{product["id"]}'
-            )
-            for product in row
+def render_menu_pages(products: list,
+                      page_size: int,
+                      items_in_row: int = 2) -> list[InlineKeyboardMarkup]:
+    pages = list()
+    for left_border in range(0, max(len(products), 1), page_size):
+        right_border = left_border + page_size
+        buttons = [
+            [
+                InlineKeyboardButton(
+                    text=product['attributes']['name'],
+                    callback_data=f'product:{product["id"]}'
+                )
+                for product in row
+            ]
+            for row in chunked(products[left_border:right_border], items_in_row)
+        ]
+        navigation_buttons = list()
+        if left_border > 0:
+            navigation_buttons.append(InlineKeyboardButton(
+                text='⬅️ предыдущие ⬅️',
+                callback_data=f'other_products:{left_border - page_size}-{left_border}'
+            ))
+        if len(products) > right_border:
+            navigation_buttons.append(InlineKeyboardButton(
+                text='➡️ следующие ➡️',
+                callback_data=f'other_products:{right_border}-{right_border + page_size}'
+            ))
+        buttons.append(navigation_buttons)
+        buttons.append([InlineKeyboardButton(text='🛒 Моя корзина 🛒', callback_data='show_cart')])
+        pages.append(InlineKeyboardMarkup(buttons))
+    return pages
+
+
+def get_menu_pages(motlin_api: Motlin, page_size: int) -> list[InlineKeyboardMarkup]:
+    # Rendered once per catalog release and page size, then served from
+    # process memory or redis. A published release changes the cache key.
+    release_id = motlin_api.get_latest_release_id()
+    cache_key = (motlin_api.catalog_id, release_id, motlin_api.node_id, page_size)
+    with menu_pages_cache_lock:
+        cached_until, pages = menu_pages_cache.get(cache_key, (0, None))
+    if datetime.now().timestamp() < cached_until:
+        return pages
+
+    pages_key = (
+        f'motlin:catalog:{motlin_api.catalog_id}:release:{release_id}'
+        f':node:{motlin_api.node_id}:menu:{page_size}'
+    )
+    serialized_pages = motlin_api.redis.get(pages_key)
+    if serialized_pages:
+        pages = [
+            InlineKeyboardMarkup.de_json(page, bot=None)
+            for page in json.loads(serialized_pages)
         ]
-        for row in chunked_products 
-    ]
-    navigation_buttons = list()
-    if left_border > 0:
-        assert left_border - 10 >= 0
-        navigation_buttons.append(InlineKeyboardButton(
-            text='⬅️ предыдущие ⬅️', callback_data=f'other_products:{left_border - 10}-{left_border}'
-        ))
-    if len(products) > right_border:
-        navigation_buttons.append(InlineKeyboardButton(
-            text='➡️ следующие ➡️', callback_data=f'other_products:{right_border}-{right_border + 10}'
-        ))
-    buttons.append(navigation_buttons)
-    buttons.append([InlineKeyboardButton(text='🛒 Моя корзина 🛒', callback_data='show_cart')])
-    return InlineKeyboardMarkup(buttons)
+    else:
+        products = motlin_api.get_products_in_release(release_id=release_id)
+        pages = render_menu_pages(products['data'], page_size)
+        if products['release_id'] != release_id:
+            # products of the previous release while the new one is not
+            # available yet, the menu is rendered again on the next call
+            return pages
+        motlin_api.redis.set(
+            pages_key,
+            json.dumps([page.to_dict() for page in pages], ensure_ascii=False),
+            ex=motlin_api.CATALOG_CACHE_TTL
+        )
 
+    with menu_pages_cache_lock:
+        menu_pages_cache.clear()
+        menu_pages_cache[cache_key] = (datetime.now().timestamp() + motlin_api.CATALOG_CACHE_TTL, pages)
+    return pages
+
+
+def make_products_inline(motlin_api: Motlin, left_border: int = 0) -> InlineKeyboardMarkup:
+    pages = get_menu_pages(motlin_api, PRODUCTS_PER_MESSAGE)
+    page_number = left_border // PRODUCTS_PER_MESSAGE
+    if not 0 <= page_number < len(pages):
+        # perhaps DB was refactored / became shorter or something else.
+        # this is emergency option
+        page_number = 0
+    return pages[page_number]
 
 
 def make_current_product_inline(product_id: str, quantity: int = 1) -> InlineKeyboardMarkup:
@@ -119,11 +181,7 @@ def display_products(motlin_api: Motlin,
     context.bot.send_message(
         update.effective_chat.id,
         'Выберите пиццу',
-        reply_markup=make_products_inline(
-            motlin_api=motlin_api,
-            left_border=0,
-            right_border=PRODUCTS_PER_MESSAGE
-        )
+        reply_markup=make_products_inline(motlin_api=motlin_api)
     )
     return 'HANDLE_MENU'
 
@@ -132,16 +190,11 @@ def display_products(motlin_api: Motlin,
 def display_other_products(motlin_api: Motlin,
                            update: Update,
                            context: CallbackContext) -> str:
-    _, left_border, right_border = re.split(r':|-', update.callback_query.data)
-    left_border, right_border = int(left_border), int(right_border)
+    _, left_border, _ = re.split(r':|-', update.callback_query.data)
     context.bot.send_message(
         update.effective_chat.id,
         'Выберите пиццу',
-        reply_markup=make_products_inline(
-            motlin_api=motlin_api,
-            left_border=left_border,
-            right_border=right_border
-        )
+        reply_markup=make_products_inline(motlin_api=motlin_api, left_border=int(left_border))
     )
     
     return 'HANDLE_MENU'
@@ -154,32 +207,50 @@ def show_product(motlin_api: Motlin,
     _, product_id = re.split(r':', update.callback_query.data)
     product = motlin_api.get_product(product_id=product_id)
     
-    pricebook = motlin_api.get_pricebook()
-    price = [
-        price['attributes']['currencies']['RUB']['amount']
-        for price in pricebook["included"]
-        if price['attributes']['sku'] == product['data']['attributes']['sku']
-    ][0]
+    price = motlin_api.get_product_price(sku=product['data']['attributes']['sku'])['RUB']['amount']
     
-    main_image_url = product['included']['main_images'][0]['link']['href']
-    image_response = requests.get(main_image_url)
+    main_image = product['included']['main_images'][0]
+    caption = dedent(
+        f"""
+        {product['data']['attributes']['name']}
+        {product['data']['attributes']['description']}
+        {price} RUB
+        """
+    )
+    reply_markup = make_current_product_inline(product_id=product_id)
+
+    file_id = motlin_api.get_photo_file_id(product_id=product_id, image_id=main_image['id'])
+    if file_id:
+        try:
+            context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup
+            )
+            return 'HANDLE_DESCRIPTION'
+        except BadRequest:
+            # file ids belong to the bot token, a new token makes them unknown
+            motlin_api.invalidate_photo_file_id(product_id=product_id)
+
+    image_response = requests.get(main_image['link']['href'])
     if image_response.ok:
         photo=image_response.content
     else:
         photo=open(os.getenv('LOGO_IMAGE'), 'rb')
     
-    context.bot.send_photo(
+    message = context.bot.send_photo(
         chat_id=update.effective_chat.id,
         photo=photo,
-        caption=dedent(
-            f"""
-            {product['data']['attributes']['name']}
-            {product['data']['attributes']['description']}
-            {price} RUB
-            """
-        ),
-        reply_markup=make_current_product_inline(product_id=product_id)
+        caption=caption,
+        reply_markup=reply_markup
     )
+    if image_response.ok:
+        motlin_api.set_photo_file_id(
+            product_id=product_id,
+            image_id=main_image['id'],
+            file_id=message.photo[-1].file_id
+        )
     return 'HANDLE_DESCRIPTION'
 
 
@@ -239,8 +310,11 @@ def add_to_cart(motlin_api: Motlin,
 
 
 @delete_prev_message
-def show_cart(motlin_api: Motlin, update: Update, context: CallbackContext) -> str:
-    user_cart = motlin_api.get_cart(user_telegram_id=update.effective_chat.id)
+def show_cart(motlin_api: Motlin,
+              update: Update,
+              context: CallbackContext,
+              session: UserSession = None) -> str:
+    user_cart = motlin_api.get_cart(user_telegram_id=update.effective_chat.id, session=session)
     if 'included' not in user_cart or not user_cart['included']['items']:
         context.bot.send_message(
             update.effective_chat.id,
@@ -293,10 +367,12 @@ def remove_from_cart(motlin_api: Motlin,
                      update: Update,
                      context: CallbackContext) -> str:
     _, item_id = update.callback_query.data.split(':')
+    session = motlin_api.sessions.load(update.effective_chat.id)
     try:
         motlin_api.remove_product_from_cart(
             user_telegram_id=update.effective_chat.id,
-            item_id=item_id
+            item_id=item_id,
+            session=session
         )
         context.bot.send_message(
             update.effective_chat.id,
@@ -304,7 +380,7 @@ def remove_from_cart(motlin_api: Motlin,
         )
     except requests.exceptions.HTTPError:
         pass
-    return show_cart(motlin_api, update, context)
+    return show_cart(motlin_api, update, context, session=session)
 
 
 @delete_prev_message
@@ -331,14 +407,13 @@ def enter_email(motlin_api: Motlin, update: Update, context: CallbackContext) ->
         )
         return 'WAITING_EMAIL'
     try:
-        customer = motlin_api.create_customer(
+        motlin_api.create_customer(
             name=update.effective_chat.first_name or \
                  update.effective_chat.username or \
                  str(update.effective_chat.id),
             email=update.message.text,
             user_telegram_id=update.effective_chat.id
         )
-        motlin_api.redis.set(f"{update.effective_chat.id}_customer_id", customer['data']['id'])
     except requests.exceptions.HTTPError as error:
         if error.response.status_code == CUSTOMER_ALREADY_EXISTS_ERROR_CODE:
             pass
@@ -355,14 +430,18 @@ def enter_email(motlin_api: Motlin, update: Update, context: CallbackContext) ->
     return 'WAITING_GEO'
 
 
-def enter_location(motlin_api: Motlin, update: Update, context: CallbackContext) -> str:
+def enter_location(motlin_api: Motlin,
+                   delivery_zones: DeliveryZones,
+                   geocoder: GeocoderCache,
+                   update: Update,
+                   context: CallbackContext) -> str:
     if update.message.location:
         customer_coords = update.message.location.longitude, update.message.location.latitude
     elif re.match(r'[?-]+[0-9]+[.|,]+[0-9]+[ ]+[?-]+[0-9]+[.|,]+[0-9]+', update.message.text):
         input_coordinates = '.'.join(update.message.text.split(','))
         customer_coords = tuple(float(coord) for coord in input_coordinates.split())
     else:
-        customer_coords = fetch_coordinates(os.getenv('YANDEX_GEO_API_KEY'), update.message.text)
+        customer_coords = geocoder.fetch_coordinates(update.message.text)
     
     if None in customer_coords:
         context.bot.send_message(
@@ -375,34 +454,28 @@ def enter_location(motlin_api: Motlin, update: Update, context: CallbackContext)
             )
         )
         return 'WAITING_GEO'
+    session = motlin_api.sessions.load(update.effective_chat.id)
     motlin_api.update_customer_address(
-        customer_id=motlin_api.redis.get(f"{update.effective_chat.id}_customer_id"),
+        customer_id=session.get('customer_id'),
         longitude=customer_coords[0],
         latitude=customer_coords[1]
     )
-    motlin_api.redis.set(f'{update.effective_chat.id}_cordinates', ':'.join(map(str, customer_coords)))
-
-    flow_meta = motlin_api.get_flow()
-    pizzerias = motlin_api.get_entries(flow_slug=flow_meta['data']['slug'])
-
-    for pizzeria in pizzerias:
-        pizzeria.update({'distance': geopy_distance.distance(
-            customer_coords,
-            (pizzeria['longitude'], pizzeria['latitude'])
-        ).km})
-    pizzerias = sorted(pizzerias, key=lambda item: item['distance'])
-    nearest_pizzeria = pizzerias[0]
-    motlin_api.redis.set(
-        f'{update.effective_chat.id}_nearest_pizzeria_id',
-        f'{nearest_pizzeria["id"]}'
+
+    delivery_zone = delivery_zones.resolve(
+        latitude=float(customer_coords[1]),
+        longitude=float(customer_coords[0])
     )
-    motlin_api.redis.set(
-        f'pizerria_{nearest_pizzeria["id"]}_admin_id',
-        nearest_pizzeria['admin_tg_id']
+    nearest_pizzeria = delivery_zone['pizzeria']
+    session.set(
+        coordinates=':'.join(map(str, customer_coords)),
+        nearest_pizzeria_id=nearest_pizzeria['id'],
+        nearest_pizzeria_admin_id=nearest_pizzeria['admin_tg_id']
     )
+    motlin_api.sessions.save(session)
 
-    distance = int(nearest_pizzeria['distance'] * 1000)
-    if nearest_pizzeria['distance'] <= 0.5:
+    distance = int(delivery_zone['distance'] * 1000)
+    delivery_tier = delivery_zone['tier']
+    if delivery_tier and not delivery_tier[1]:
         context.bot.send_message(
             update.effective_chat.id,
             text=dedent(
@@ -419,37 +492,21 @@ def enter_location(motlin_api: Motlin, update: Update, context: CallbackContext)
                 InlineKeyboardButton(text='Заберу сам.', callback_data='pickup')
             ]])
         )
-    elif nearest_pizzeria['distance'] <= 5:
-        context.bot.send_message(
-            update.effective_chat.id,
-            text=dedent(
-                f'''
-                Ваша пицца всего в {distance} метрах от вас!
-                Адрес: {nearest_pizzeria['address']}.
-                Стоимость доставки - 100 рублей.
-
-                Или можете забрать ваш заказ самостоятельно!
-                '''
-            ),
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(text='Оформить доставку', callback_data='delivery:::100'),
-                InlineKeyboardButton(text='Заберу сам.', callback_data='pickup')
-            ]])
-        )
-    elif nearest_pizzeria['distance'] <= 20:
+    elif delivery_tier:
+        _, delivery_price = delivery_tier
         context.bot.send_message(
             update.effective_chat.id,
             text=dedent(
                 f'''
                 Ваша пицца всего в {distance} метрах от вас!
                 Адрес: {nearest_pizzeria['address']}.
-                Стоимость доставки - 200 рублей.
+                Стоимость доставки - {delivery_price} рублей.
 
                 Или можете забрать ваш заказ самостоятельно!
                 '''
             ),
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(text='Оформить доставку', callback_data='delivery:::200'),
+                InlineKeyboardButton(text='Оформить доставку', callback_data=f'delivery:::{delivery_price}'),
                 InlineKeyboardButton(text='Заберу сам.', callback_data='pickup')
             ]])
         )
@@ -468,10 +525,15 @@ def enter_location(motlin_api: Motlin, update: Update, context: CallbackContext)
     return 'DELIVERY'
 
 
-def delete_cart(motlin_api: Motlin, update: Update, context: CallbackContext) -> None:
-    cart_id = motlin_api.redis.get(f'{update.effective_chat.id}_cart_id')
-    motlin_api.delete_cart(cart_id=cart_id)
-    motlin_api.redis.delete(f'{update.effective_chat.id}_cart_id')
+def delete_cart(motlin_api: Motlin,
+                update: Update,
+                context: CallbackContext,
+                session: UserSession = None) -> None:
+    if session is None:
+        session = motlin_api.sessions.load(update.effective_chat.id)
+    motlin_api.delete_cart(cart_id=session['cart_id'])
+    session.delete('cart_id', 'cart_expired', 'is_delivery')
+    motlin_api.sessions.save(session)
 
 
 @delete_prev_message
@@ -480,12 +542,14 @@ def make_payment(motlin_api: Motlin,
                  context: CallbackContext,
                  delivery_price: int = 0,
                  is_delivery: bool = False) -> None:
-    cart_meta = motlin_api.get_cart(user_telegram_id=update.effective_chat.id)
+    session = motlin_api.sessions.load(update.effective_chat.id)
+    cart_meta = motlin_api.get_cart(user_telegram_id=update.effective_chat.id, session=session)
     description = ', '.join([f'{item["name"]} - {item["quantity"]}' for item in cart_meta['included']['items']])
     if delivery_price:
         description += f', доставка - {delivery_price}'
     price = cart_meta['data']['meta']['display_price']['with_tax']['amount'] + delivery_price
-    motlin_api.redis.set(f"{cart_meta['data']['id']}_is_delivery", 1 if is_delivery else 0)
+    session.set(is_delivery=1 if is_delivery else 0)
+    motlin_api.sessions.save(session)
     context.bot.send_invoice(
         chat_id=update.effective_chat.id,
         title='Заказ пиццы',
@@ -513,14 +577,23 @@ def delivery(motlin_api: Motlin, job_queue: JobQueue, update: Update, context: C
     
 
 @delete_prev_message
-def finish_order(job_queue: JobQueue, update: Update, context: CallbackContext):
-    customer_id = motlin_api.redis.get(f"{update.effective_chat.id}_customer_id")
-    customer_meta = motlin_api.get_customer(customer_id=customer_id)
-    is_delivery = bool(int(motlin_api.redis.get(f"{update.message.successful_payment.invoice_payload}_is_delivery")))
-    nearest_pizerria_id = motlin_api.redis.get(f'{update.effective_chat.id}_nearest_pizzeria_id')
+def finish_order(motlin_api: Motlin,
+                 async_motlin: AsyncMotlin,
+                 job_queue: JobQueue,
+                 update: Update,
+                 context: CallbackContext):
+    # everything the order needs is in the session, one redis read
+    session = motlin_api.sessions.load(update.effective_chat.id)
+    is_delivery = bool(int(session.get('is_delivery', 0)))
+    nearest_pizerria_id = session.get('nearest_pizzeria_id')
     if is_delivery:
-        admin_tg_id = int(motlin_api.redis.get(f'pizerria_{nearest_pizerria_id}_admin_id'))
-        user_cart = motlin_api.get_cart(user_telegram_id=update.effective_chat.id)
+        admin_tg_id = session.get('nearest_pizzeria_admin_id') or \
+            motlin_api.get_pizzeria(entry_id=nearest_pizerria_id)['admin_tg_id']
+        admin_tg_id = int(admin_tg_id)
+        customer_meta, user_cart = async_motlin.run_concurrently(
+            async_motlin.get_customer(customer_id=session.get('customer_id')),
+            async_motlin.get_cart(user_telegram_id=update.effective_chat.id, session=session)
+        )
 
         cart_message = dedent(
             """
@@ -556,24 +629,25 @@ def finish_order(job_queue: JobQueue, update: Update, context: CallbackContext):
             ),
             "inline_reply_markup": None
         }
-        job_queue.run_once(scheduled_message, 5, context=json.dumps(message_meta, ensure_ascii=False))
+        run_once(job_queue, context, scheduled_message, 5, json.dumps(message_meta, ensure_ascii=False))
     else:
-        flow_meta = motlin_api.get_flow()
-        nearest_pizzeria_meta = motlin_api.get_entry(flow_slug=flow_meta['data']['slug'], entry_id=nearest_pizerria_id)
+        nearest_pizzeria = motlin_api.get_pizzeria(entry_id=nearest_pizerria_id)
         context.bot.send_message(
             update.effective_chat.id,
             'Ваш заказ взят в работу, будет готов в течение часа. Ждем вас.'
         )
         context.bot.send_location(
             chat_id=update.effective_chat.id,
-            longitude=nearest_pizzeria_meta['data']['longitude'],
-            latitude=nearest_pizzeria_meta['data']['latitude']
+            longitude=nearest_pizzeria['longitude'],
+            latitude=nearest_pizzeria['latitude']
         )
-    delete_cart(motlin_api=motlin_api, update=update, context=context)
+    delete_cart(motlin_api=motlin_api, update=update, context=context, session=session)
     return display_products(motlin_api, update, context)
 
 
 def scheduled_message(context: CallbackContext):
+    if not claim_job(context):
+        return
     message_meta = json.loads(context.job.context)
     inline_components = message_meta.get('inline_reply_markup')
     inline_keyboard = None
@@ -597,10 +671,133 @@ def scheduled_message(context: CallbackContext):
     )
 
 
-if __name__ == '__main__':
-    env = Env()
-    env.read_env()
+def cleanup_sessions(motlin_api: Motlin, context: CallbackContext) -> None:
+    motlin_api.sessions.prune()
+
+
+def create_metrics(env: Env, shard: int = None) -> dict:
+    # one Metrics per component, all None when metrics are off. Shard workers
+    # of sharded_bot.py export on the ports after METRICS_PORT, to files
+    # prefixed with shard{N}_.
+    components = ('motlin', 'geocoder', 'bot')
+    if not (env.int('METRICS_PORT', None) or env.str('METRICS_JSON_PATH', None)):
+        return dict.fromkeys(components)
+    metrics = {component: Metrics(component) for component in components}
+    if env.int('METRICS_PORT', None):
+        port = env.int('METRICS_PORT') if shard is None else env.int('METRICS_PORT') + 1 + shard
+        start_prometheus_exporter(port, *metrics.values())
+    if env.str('METRICS_JSON_PATH', None):
+        metrics_dir, metrics_file = os.path.split(env.str('METRICS_JSON_PATH'))
+        if shard is not None:
+            metrics_file = f'shard{shard}_{metrics_file}'
+        metrics['motlin'].start_json_dump(
+            os.path.join(metrics_dir, metrics_file),
+            env.float('METRICS_DUMP_INTERVAL', 60)
+        )
+        for component in components[1:]:
+            metrics[component].start_json_dump(
+                os.path.join(metrics_dir, f'{component}_{metrics_file}'),
+                env.float('METRICS_DUMP_INTERVAL', 60)
+            )
+    return metrics
+
+
+def create_updater(env: Env,
+                   bot_metrics: Metrics = None,
+                   update_queue_size: int = 0,
+                   persistence: RedisPersistence = None) -> Updater:
+    # update_queue_size bounds the queue between the webhook and the dispatcher, 0 is unbounded
+    chat_workers = env.int('BOT_WORKERS', 8)
+    if not chat_workers and not update_queue_size:
+        # every update on the single dispatcher thread, as before
+        return Updater(token=env.str('TELEGRAM_BOT_TOKEN'), use_context=True, persistence=persistence)
+
+    bot = Bot(
+        token=env.str('TELEGRAM_BOT_TOKEN'),
+        # every chat worker may be sending at the same time
+        request=Request(con_pool_size=chat_workers + 4)
+    )
+    job_queue = JobQueue()
+    if chat_workers:
+        dispatcher = ChatOrderedDispatcher(
+            bot,
+            Queue(maxsize=update_queue_size),
+            job_queue=job_queue,
+            persistence=persistence,
+            chat_workers=chat_workers,
+            metrics=bot_metrics,
+            max_pending=update_queue_size
+        )
+    else:
+        dispatcher = Dispatcher(
+            bot,
+            Queue(maxsize=update_queue_size),
+            job_queue=job_queue,
+            persistence=persistence
+        )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def create_conversation_handler(motlin_api: Motlin,
+                                async_motlin: AsyncMotlin,
+                                delivery_zones: DeliveryZones,
+                                geocoder: GeocoderCache,
+                                job_queue: JobQueue,
+                                persistent: bool = False) -> ConversationHandler:
+    return ConversationHandler(
+        name='checkout',
+        persistent=persistent,
+        entry_points = [
+            CommandHandler('start', partial(display_products, motlin_api))
+        ],
+        states = {
+            'HANDLE_MENU': [
+                CallbackQueryHandler(callback=partial(show_product, motlin_api), pattern='product'),
+                CallbackQueryHandler(callback=partial(display_other_products, motlin_api), pattern='other_products'),
+                CallbackQueryHandler(callback=partial(show_cart, motlin_api), pattern='show_cart'),
+            ],
+            'HANDLE_DESCRIPTION': [
+                CallbackQueryHandler(callback=partial(display_products, motlin_api), pattern='main_menu'),
+                CallbackQueryHandler(callback=increase_quantity, pattern='increase_quantity'),
+                CallbackQueryHandler(callback=reduce_quantity, pattern='reduce_quantity'),
+                CallbackQueryHandler(callback=partial(add_to_cart, motlin_api), pattern='add_to_cart'),
+                CallbackQueryHandler(callback=partial(remove_from_cart, motlin_api), pattern='remove_from_cart'),
+                CallbackQueryHandler(callback=partial(show_cart, motlin_api), pattern='show_cart'),
+                CallbackQueryHandler(callback=make_order, pattern='make_order')
+            ],
+            'WAITING_EMAIL': [
+                MessageHandler(filters=Filters.text, callback=partial(enter_email, motlin_api))
+            ],
+            'WAITING_GEO': [
+                MessageHandler(filters=Filters.all, callback=partial(enter_location, motlin_api, delivery_zones, geocoder)),
+            ],
+            'DELIVERY': [
+                CallbackQueryHandler(callback=partial(display_products, motlin_api), pattern='back_to_store'),
+                CallbackQueryHandler(callback=partial(make_payment, motlin_api), pattern='pickup'),
+                CallbackQueryHandler(callback=partial(delivery, motlin_api, job_queue), pattern='delivery'),
+            ],
+            'PAYMENT': [
+                MessageHandler(
+                    Filters.successful_payment,
+                    partial(finish_order, motlin_api, async_motlin, job_queue),
+                    pass_chat_data=True
+                ),
+            ]
+        },
+        fallbacks=[
+        ]
+    )
+
 
+def create_bot(env: Env,
+               metrics: dict,
+               update_queue_size: int = 0,
+               run_maintenance: bool = True) -> Updater:
+    # run_maintenance is off for all shard workers but one, see sharded_bot.py
+    global PRODUCTS_PER_MESSAGE
+    PRODUCTS_PER_MESSAGE = env.int('PRODUCTS_PER_MESSAGE', 10)
+    session_ttl = env.int('SESSION_TTL_DAYS', 30) * 24 * ONE_HOUR
     motlin_api = Motlin(
         env.str('CLIENT_ID'),
         env.str('CLIENT_SECRET'),
@@ -608,50 +805,96 @@ if __name__ == '__main__':
         env.str('NODE_ID'),
         env.str('PRICEBOOK_ID'),
         env.str('PIZZERIAS_FLOW_ID'),
+        token_renewal=env.bool('MOTLIN_TOKEN_RENEWAL', True),
+        rate_limit=env.float('MOTLIN_RATE_LIMIT', 20),
+        metrics=metrics['motlin'],
+        session_ttl=session_ttl,
     )
-    
-    updater = Updater(token=env.str('TELEGRAM_BOT_TOKEN'), use_context=True)
+    async_motlin = AsyncMotlin(
+        env.str('CLIENT_ID'),
+        env.str('CLIENT_SECRET'),
+        env.str('CATALOG_ID'),
+        env.str('NODE_ID'),
+        env.str('PRICEBOOK_ID'),
+        env.str('PIZZERIAS_FLOW_ID'),
+        rate_limiter=motlin_api.rate_limiter,
+        metrics=metrics['motlin'],
+        session_ttl=session_ttl,
+        token_renewer=motlin_api.token_renewer,
+    )
+
+    geocoder = GeocoderCache(
+        env.str('YANDEX_GEO_API_KEY'),
+        motlin_api.redis,
+        metrics=metrics['geocoder'],
+        gazetteer=Gazetteer.load(env.str('GAZETTEER_PATH')) if env.str('GAZETTEER_PATH', None) else None
+    )
+    delivery_zones = DeliveryZones(
+        motlin_api,
+        cell_size=env.float('DELIVERY_ZONE_CELL_SIZE', DeliveryZones.CELL_SIZE)
+    )
+
+    persistence = None
+    if env.bool('REDIS_PERSISTENCE', True):
+        persistence = RedisPersistence(
+            motlin_api.redis,
+            ttl=session_ttl,
+            flush_interval=env.float('PERSISTENCE_FLUSH_INTERVAL', RedisPersistence.FLUSH_INTERVAL)
+        )
+    updater = create_updater(env, metrics['bot'], update_queue_size, persistence)
     job_queue = updater.job_queue
+    if run_maintenance:
+        job_queue.run_repeating(
+            partial(cleanup_sessions, motlin_api),
+            interval=env.int('SESSION_CLEANUP_INTERVAL', ONE_HOUR),
+            first=60
+        )
+    if run_maintenance and env.int('PREWARM_CHAT_ID', None):
+        threading.Thread(
+            target=prewarm_catalog,
+            args=(motlin_api, updater.bot, env.int('PREWARM_CHAT_ID')),
+            name='catalog-prewarm',
+            daemon=True
+        ).start()
     updater.dispatcher.add_handler(
-        ConversationHandler(
-            entry_points = [
-                CommandHandler('start', partial(display_products, motlin_api))
-            ],
-            states = {
-                'HANDLE_MENU': [
-                    CallbackQueryHandler(callback=partial(show_product, motlin_api), pattern='product'),
-                    CallbackQueryHandler(callback=partial(display_other_products, motlin_api), pattern='other_products'),
-                    CallbackQueryHandler(callback=partial(show_cart, motlin_api), pattern='show_cart'),
-                ],
-                'HANDLE_DESCRIPTION': [
-                    CallbackQueryHandler(callback=partial(display_products, motlin_api), pattern='main_menu'),
-                    CallbackQueryHandler(callback=increase_quantity, pattern='increase_quantity'),
-                    CallbackQueryHandler(callback=reduce_quantity, pattern='reduce_quantity'),
-                    CallbackQueryHandler(callback=partial(add_to_cart, motlin_api), pattern='add_to_cart'),
-                    CallbackQueryHandler(callback=partial(remove_from_cart, motlin_api), pattern='remove_from_cart'),
-                    CallbackQueryHandler(callback=partial(show_cart, motlin_api), pattern='show_cart'),
-                    CallbackQueryHandler(callback=make_order, pattern='make_order')
-                ],
-                'WAITING_EMAIL': [
-                    MessageHandler(filters=Filters.text, callback=partial(enter_email, motlin_api))
-                ],
-                'WAITING_GEO': [
-                    MessageHandler(filters=Filters.all, callback=partial(enter_location, motlin_api)),
-                ],
-                'DELIVERY': [
-                    CallbackQueryHandler(callback=partial(display_products, motlin_api), pattern='back_to_store'),
-                    CallbackQueryHandler(callback=partial(make_payment, motlin_api), pattern='pickup'),
-                    CallbackQueryHandler(callback=partial(delivery, motlin_api, job_queue), pattern='delivery'),
-                ],
-                'PAYMENT': [
-                    MessageHandler(Filters.successful_payment, partial(finish_order, job_queue), pass_chat_data=True),
-                ]
-            },
-            fallbacks=[
-            ]
+        create_conversation_handler(
+            motlin_api,
+            async_motlin,
+            delivery_zones,
+            geocoder,
+            job_queue,
+            persistent=persistence is not None
         )
     )
+    if persistence is not None:
+        persistence.restore_jobs(job_queue, {'scheduled_message': scheduled_message})
     updater.dispatcher.add_handler(PreCheckoutQueryHandler(confirm_payment))
-    updater.start_polling()
-    updater.idle()
+    return updater
 
+
+if __name__ == '__main__':
+    env = Env()
+    env.read_env()
+
+    metrics = create_metrics(env)
+    webhook_port = env.int('WEBHOOK_PORT', None)
+    updater = create_bot(
+        env,
+        metrics,
+        update_queue_size=env.int('WEBHOOK_QUEUE_SIZE', 1000) if webhook_port else 0
+    )
+    if webhook_port:
+        run_webhook(
+            updater,
+            webhook_port,
+            env.str('WEBHOOK_SECRET'),
+            webhook_url=env.str('WEBHOOK_URL', None),
+            path=env.str('WEBHOOK_PATH', '/telegram'),
+            metrics=metrics['bot']
+        )
+    else:
+        updater.start_polling()
+        updater.idle()
+    if updater.persistence is not None:
+        # states changed by the updates handled while stopping
+        updater.persistence.flush()
@@ -0,0 +1,123 @@
+from __future__ import annotations
+import hmac
+import json
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from metrics import Metrics
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Telegram retries a webhook call that did not get 2xx, so a full queue answers 503
+RETRY_AFTER_SECONDS = 1
+MAX_BODY_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def start_webhook_server(update_queue: Queue,
+                         bot: Bot,
+                         port: int,
+                         secret_token: str,
+                         path: str = '/telegram',
+                         host: str = '0.0.0.0',
+                         metrics: Metrics = None) -> ThreadingHTTPServer:
+    # Updates are put into update_queue without blocking. The queue should be
+    # bounded (Queue(maxsize)), a full one is the backpressure signal. Anything
+    # with put(item, block) raising queue.Full and qsize() does as a queue.
+
+    def count_request(status: int) -> None:
+        if metrics is not None:
+            metrics.inc('webhook_requests_total', {'status': status})
+            metrics.set_gauge('webhook_queue_size', {}, update_queue.qsize())
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _answer(self, status: int, headers: dict = None) -> None:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            count_request(status)
+
+        def do_POST(self):
+            content_length = int(self.headers.get('Content-Length', 0))
+            if self.path != path:
+                self.close_connection = True
+                self._answer(404)
+                return
+            if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), secret_token):
+                self.close_connection = True
+                self._answer(403)
+                return
+            if not 0 < content_length <= MAX_BODY_SIZE:
+                self.close_connection = True
+                self._answer(413 if content_length else 400)
+                return
+            try:
+                update = Update.de_json(json.loads(self.rfile.read(content_length)), bot)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                update = None
+            if update is None:
+                self._answer(400)
+                return
+            try:
+                update_queue.put(update, block=False)
+            except Full:
+                self._answer(503, {'Retry-After': str(RETRY_AFTER_SECONDS)})
+                return
+            self._answer(200)
+
+        def do_GET(self):
+            self._answer(404)
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    return server
+
+
+def start_dispatching(updater: Updater) -> None:
+    # what start_polling starts besides the polling itself, updater.stop() stops it
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.running = True
+
+
+def run_webhook(updater: Updater,
+                port: int,
+                secret_token: str,
+                webhook_url: str = None,
+                path: str = '/telegram',
+                metrics: Metrics = None) -> None:
+    # webhook counterpart of updater.start_polling() + updater.idle()
+    server = start_webhook_server(
+        updater.update_queue,
+        updater.bot,
+        port,
+        secret_token,
+        path=path,
+        metrics=metrics
+    )
+    if webhook_url:
+        updater.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            max_connections=100
+        )
+    start_dispatching(updater)
+    logger.info('Webhook is listening on port %s', port)
+    try:
+        updater.idle()
+    finally:
+        server.shutdown()